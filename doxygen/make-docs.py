@@ -12,7 +12,8 @@ Run this script from the doc directory, as
 It will generate a doxygen configuration file (Doxyfile) and download
 additional files to make links to the IMP documentation (ref-tags.xml
 and manual-tags.xml), then run doxygen to make documentation in the
-doc/html/ subdirectory.
+doc/html/ subdirectory. Downloaded tag files are cached in doc/.tagcache/ and
+only fetched again if they have changed on the web site.
 
 The documentation can be rebuilt by just running 'doxygen Doxyfile'.
 """
@@ -23,7 +24,15 @@ import os
 import glob
 import re
 import argparse
-from urllib.request import urlopen
+import shutil
+import contextlib
+import functools
+import ssl
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from tutorial_common import get_git_branch, get_git_repo, get_doxygen_template
 
 # Latest IMP stable release
 IMP_STABLE_RELEASE = '2.22.0'
@@ -34,6 +43,21 @@ TOPDIR = os.path.abspath('..')
 # Path to this directory (containing doxygen inputs)
 DOXDIR = os.path.abspath(os.path.dirname(__file__))
 
+# Directory in which to keep downloaded tag files between builds
+TAG_CACHE = '.tagcache'
+
+# Regex to extract the page name from a markdown file
+PAGE_NAME_RE = re.compile(r'{#(\S+)}')
+
+# Regexes to find the lines in doxygen HTML output after which we add links
+INIT_MENU_RE = re.compile(rb"^  initMenu\('',false,false.*\n?", re.MULTILINE)
+FOOTER_RE = re.compile(rb'^<hr class="footer".*\n?', re.MULTILINE)
+
+# Javascript to add an "Edit on GitHub" link to each page, given the
+# repository name, branch, and source markdown file
+EDIT_LINK_TEMPLATE = '  $(\'#main-menu\').append(\'<li style="float:right"><div id="github_edit"><a href="https://github.com/salilab/%s/blob/%s/doc/%s"><i class="fab fa-github"></i> Edit on GitHub</a></div></li>\');\n'
+
+@functools.lru_cache(maxsize=None)
 def get_title():
     """Get the title of the repository by reading the metadata.yaml file"""
     fnames = [os.path.join(TOPDIR, subdir, 'metadata.yaml')
@@ -46,50 +70,49 @@ def get_title():
 
 def read_yaml_file(fname):
     # Avoid 'import yaml' since it isn't in the standard library
-    with open(fname) as fh:
-        for line in fh:
-            if line.startswith('title:'):
-                return line.split(':', 1)[1].strip()
+    with open(fname, 'rb') as fh:
+        contents = b'\n' + fh.read()
+    start = contents.find(b'\ntitle:')
+    if start == -1:
+        raise ValueError("Could not find title in %s" % fname)
+    start += len(b'\ntitle:')
+    end = contents.find(b'\n', start)
+    if end == -1:
+        end = len(contents)
+    return contents[start:end].decode('utf-8').strip()
 
 def make_doxyfile(tags):
     tagfiles = " ".join(("%s=%s" % (t.xml_filename, t.doctop)) for t in tags)
     title = get_title()
-    # Generate doxygen template
-    p = subprocess.Popen(['doxygen', '-s', '-g', '-'], stdout=subprocess.PIPE,
-                         universal_newlines=True)
-    # Substitute in our custom config
+    # Our custom config, keyed by doxygen setting name
+    replacements = {
+        'LAYOUT_FILE': 'LAYOUT_FILE = %s/layout.xml\n' % DOXDIR,
+        'PROJECT_NAME': 'PROJECT_NAME = "%s"\n' % title,
+        'INPUT': 'INPUT = .\n',
+        'SEARCHENGINE': 'SEARCHENGINE = NO\n',
+        'TOC_INCLUDE_HEADINGS': 'TOC_INCLUDE_HEADINGS = 2\n',
+        'IMAGE_PATH': 'IMAGE_PATH = images\n',
+        'EXAMPLE_PATH': 'EXAMPLE_PATH = ..\n',
+        'HTML_HEADER': 'HTML_HEADER = %s/header.html\n' % DOXDIR,
+        'HTML_FOOTER': 'HTML_FOOTER = %s/footer.html\n' % DOXDIR,
+        'GENERATE_LATEX': 'GENERATE_LATEX = NO\n',
+        'USE_MATHJAX': 'USE_MATHJAX = YES\n',
+        'MATHJAX_RELPATH':
+                'MATHJAX_RELPATH = //integrativemodeling.org/mathjax\n',
+        'TAGFILES': 'TAGFILES = %s\n' % tagfiles}
+    # Substitute our custom config into the doxygen template
+    out = []
+    for line in get_doxygen_template():
+        key = line.split(None, 1)[0] if line.strip() else ''
+        out.append(replacements.get(key, line))
     with open('Doxyfile', 'w') as fh:
-        for line in p.stdout:
-            if line.startswith('LAYOUT_FILE '):
-                line = 'LAYOUT_FILE = %s/layout.xml\n' % DOXDIR
-            elif line.startswith('PROJECT_NAME '):
-                line = 'PROJECT_NAME = "%s"\n' % title
-            elif line.startswith('INPUT '):
-                line = 'INPUT = .\n'
-            elif line.startswith('SEARCHENGINE '):
-                line = 'SEARCHENGINE = NO\n'
-            elif line.startswith('TOC_INCLUDE_HEADINGS '):
-                line = 'TOC_INCLUDE_HEADINGS = 2\n'
-            elif line.startswith('IMAGE_PATH '):
-                line = 'IMAGE_PATH = images\n'
-            elif line.startswith('EXAMPLE_PATH '):
-                line = 'EXAMPLE_PATH = ..\n'
-            elif line.startswith('HTML_HEADER '):
-                line = 'HTML_HEADER = %s/header.html\n' % DOXDIR
-            elif line.startswith('HTML_FOOTER '):
-                line = 'HTML_FOOTER = %s/footer.html\n' % DOXDIR
-            elif line.startswith('GENERATE_LATEX '):
-                line = 'GENERATE_LATEX = NO\n'
-            elif line.startswith('USE_MATHJAX '):
-                line = 'USE_MATHJAX = YES\n'
-            elif line.startswith('MATHJAX_RELPATH '):
-                line = 'MATHJAX_RELPATH = //integrativemodeling.org/mathjax\n'
-            elif line.startswith('TAGFILES '):
-                line = 'TAGFILES = %s\n' % tagfiles
-            fh.write(line)
-    ret = p.wait()
-    if ret != 0:
-        raise OSError("doxygen failed")
+        fh.write(''.join(out))
+
+@functools.lru_cache(maxsize=None)
+def _get_ssl_context():
+    """Get an SSL context shared by all downloads, so that the system
+       certificates are only loaded once"""
+    return ssl.create_default_context()
 
 class TagFile(object):
     """Represent a doxygen XML tag file"""
@@ -97,6 +120,7 @@ class TagFile(object):
     def __init__(self, doctype, imp_version):
         # Path to top of IMP documentation
         self._urltop = 'https://integrativemodeling.org/%s/doc' % imp_version
+        self.imp_version = imp_version
 
         # doctype should be 'manual' or 'ref'
         self.doctype = doctype
@@ -104,57 +128,85 @@ class TagFile(object):
         # URL for the documentation
         self.doctop = '%s/%s/' % (self._urltop, doctype)
 
+        # Path to the XML tag file on the local disk (once downloaded)
+        self.xml_filename = "%s-tags.xml" % doctype
+
     def download(self):
         """Get the tag file from the web site and put it on the local disk"""
-        fname = "%s-tags.xml" % self.doctype
-        response = urlopen('%s/%s' % (self._urltop, fname))
-        with open(fname, 'wb') as fh:
-            fh.write(response.read())
-        # Path to the XML tag file on the local disk
-        self.xml_filename = fname
+        fname = self.xml_filename
+        cache = os.path.join(TAG_CACHE, "%s-%s" % (self.imp_version, fname))
+        # HTTP headers from the previous download, if any, let us ask the
+        # server to only send the file if it has changed since
+        cache_headers = cache + '.headers'
+        request_headers = {}
+        if os.path.exists(cache) and os.path.exists(cache_headers):
+            with open(cache_headers) as fh:
+                old_headers = json.load(fh)
+            if old_headers.get('ETag'):
+                request_headers['If-None-Match'] = old_headers['ETag']
+            if old_headers.get('Last-Modified'):
+                request_headers['If-Modified-Since'] = \
+                        old_headers['Last-Modified']
+        try:
+            response = urlopen(Request('%s/%s' % (self._urltop, fname),
+                                       headers=request_headers),
+                               context=_get_ssl_context())
+        except HTTPError as err:
+            if err.code != 304:
+                raise
+            # Not modified, so the cached copy is up to date
+        else:
+            os.makedirs(TAG_CACHE, exist_ok=True)
+            # Invalidate the cache until the new file is completely written
+            if os.path.exists(cache_headers):
+                os.unlink(cache_headers)
+            # Stream to disk rather than holding the whole file in memory
+            with contextlib.closing(response):
+                with open(cache, 'wb', buffering=1024 * 1024) as fh:
+                    shutil.copyfileobj(response, fh, length=1024 * 1024)
+                new_headers = dict((h, response.headers[h])
+                                   for h in ('ETag', 'Last-Modified')
+                                   if response.headers[h])
+            with open(cache_headers, 'w') as fh:
+                json.dump(new_headers, fh)
+        shutil.copyfile(cache, fname)
 
 
 def get_tag_files(imp_version):
-    tags = [TagFile(doctype, imp_version) for doctype in ('manual', 'ref')]
-    for t in tags:
-        t.download()
-    return tags
+    return [TagFile(doctype, imp_version) for doctype in ('manual', 'ref')]
+
+def download_tag_files(tags):
+    # Fetch all files at once, so that we only wait for the slowest one
+    with ThreadPoolExecutor(max_workers=len(tags)) as executor:
+        list(executor.map(lambda t: t.download(), tags))
 
 def run_doxygen():
     subprocess.check_call(['doxygen', 'Doxyfile'])
 
-def get_git_branch():
-    return subprocess.check_output(['git', 'rev-parse', '--abbrev-ref',
-                                    'HEAD'],
-                                   universal_newlines=True).rstrip('\r\n')
-
-def get_git_repo():
-    url = subprocess.check_output(['git', 'config', '--get',
-                                   'remote.origin.url'],
-                                   universal_newlines=True).rstrip('\r\n')
-    pth, repo = os.path.split(url)
-    if repo.endswith('.git'):
-        repo = repo[:-4]
-    return repo
-
-def get_pagename(filename, regex):
+def get_pagename(filename, regex=PAGE_NAME_RE):
     with open(filename) as fh:
-        for line in fh:
-            m = regex.search(line)
-            if m:
-                return m.group(1)
+        # The page name is usually near the top, so avoid reading the
+        # whole file if possible
+        contents = fh.read(65536)
+        m = regex.search(contents)
+        if not m:
+            m = regex.search(contents + fh.read())
+    if m:
+        return m.group(1)
     raise ValueError("Could not determine page name for file %s" % filename)
 
+def _get_html_name(md):
+    pagename = get_pagename(md)
+    if pagename == 'mainpage':
+        pagename = 'index'
+    return 'html/%s.html' % pagename, md
+
 def get_page_map():
-    m = {}
-    page_name_md_re = re.compile(r'{#(\S+)}')
-    for md in glob.glob("*.md"):
-        pagename = get_pagename(md, page_name_md_re)
-        if pagename == 'mainpage':
-            pagename = 'index'
-        m['html/%s.html' % pagename] = md
-    return m
+    # Scanning each file is independent and I/O bound, so do it in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return dict(executor.map(_get_html_name, glob.glob("*.md")))
 
+@functools.lru_cache(maxsize=None)
 def get_license():
     fname = '../LICENSE'
     if not os.path.exists(fname):
@@ -162,6 +214,7 @@ def get_license():
     with open(fname) as fh:
         return fh.read()
 
+@functools.lru_cache(maxsize=None)
 def get_license_link():
     license = get_license()
     if 'Attribution-ShareAlike 4.0 International' in license:
@@ -179,27 +232,35 @@ def add_html_links(branch):
     license_link = get_license_link()
     repo = get_git_repo()
     pagemap = get_page_map()
-    for html in glob.glob("html/*.html"):
-        if html != 'html/pages.html':
-            patch_html(html, repo, pagemap[html], branch, license_link)
+    # Only the pages generated from our markdown files need to be patched
+    # (skipping any that doxygen did not generate)
+    pages = [(html, md) for html, md in pagemap.items()
+             if os.path.exists(html)]
+    # Patching is I/O bound, so handle multiple files at once
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        # Consume the results so that any exception is propagated
+        list(executor.map(
+            lambda page: patch_html(page[0], repo, page[1], branch,
+                                    license_link), pages))
 
 def patch_html(filename, repo, source, branch, license_link):
-    edit_link = '  $(\'#main-menu\').append(\'<li style="float:right"><div id="github_edit"><a href="https://github.com/salilab/%s/blob/%s/doc/%s"><i class="fab fa-github"></i> Edit on GitHub</a></div></li>\');\n' % (repo, branch, source)
-
-    with open(filename) as fh:
-        contents = fh.readlines()
-    patched = False
-    with open(filename, 'w') as fh:
-        for line in contents:
-            fh.write(line)
-            if line.startswith("  initMenu('',false,false"):
-                patched = True
-                fh.write(edit_link)
-            if line.startswith('<hr class="footer"'):
-                fh.write(license_link)
+    edit_link = (EDIT_LINK_TEMPLATE % (repo, branch, source)).encode()
+    license_link = license_link.encode()
+    with open(filename, 'rb') as fh:
+        contents = fh.read()
+    # Nothing to do if the file was already patched by a previous run
+    if b'id="github_edit"' in contents:
+        return
+    contents, patched = INIT_MENU_RE.subn(
+        lambda m: m.group(0) + edit_link, contents)
     if not patched:
         raise ValueError("Failed to patch %s to add GitHub-edit link"
                          % filename)
+    if license_link:
+        contents = FOOTER_RE.sub(
+            lambda m: m.group(0) + license_link, contents)
+    with open(filename, 'wb') as fh:
+        fh.write(contents)
 
 def fix_menu_links(imp_version):
     # The generated html/menudata.js contains links to the IMP nightly build.
@@ -208,10 +269,13 @@ def fix_menu_links(imp_version):
     if imp_version == 'nightly':
         return
     fname = 'html/menudata.js'
-    with open(fname, 'r') as fh:
+    with open(fname, 'rb') as fh:
         contents = fh.read()
-    with open(fname, 'w') as fh:
-        fh.write(contents.replace('nightly', imp_version))
+    # Don't rewrite the file if there is nothing to change (e.g. on a rerun)
+    if b'nightly' not in contents:
+        return
+    with open(fname, 'wb') as fh:
+        fh.write(contents.replace(b'nightly', imp_version.encode()))
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Build tutorial docs")
@@ -229,7 +293,12 @@ def main():
     imp_version = IMP_STABLE_RELEASE if branch == 'main' else 'nightly'
 
     tags = get_tag_files(imp_version)
-    make_doxyfile(tags)
+    # The tag files are only read when doxygen runs, so download them
+    # while we set up the Doxyfile
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        download = executor.submit(download_tag_files, tags)
+        make_doxyfile(tags)
+        download.result()
     run_doxygen()
     add_html_links(branch)
     fix_menu_links(imp_version)
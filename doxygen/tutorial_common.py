@@ -0,0 +1,144 @@
+"""
+Utility functions shared by make-docs.py and notebook/process_notebook.py.
+"""
+
+import os
+import subprocess
+import functools
+import configparser
+import hashlib
+import shutil
+import tempfile
+
+
+def find_toplevel():
+    """Get the top directory of the repository by walking up from the
+       current directory until we find .git (which may be a file, for
+       worktrees and submodules)"""
+    d = os.getcwd()
+    while not os.path.exists(os.path.join(d, '.git')):
+        parent = os.path.dirname(d)
+        if parent == d:
+            raise ValueError("Could not determine top directory of repository")
+        d = parent
+    return d
+
+
+@functools.lru_cache(maxsize=None)
+def get_git_dirs():
+    """Get the git directory and the common git directory (which has the
+       config; it differs only for worktrees) without running git.
+       Both are absolute paths, wherever in the repository we are run from"""
+    gitdir = os.path.join(find_toplevel(), '.git')
+    if os.path.isfile(gitdir):
+        # Worktrees and submodules point to the real directory with a file
+        with open(gitdir) as fh:
+            line = fh.readline().rstrip('\r\n')
+        if not line.startswith('gitdir: '):
+            raise ValueError("Unexpected contents of %s" % gitdir)
+        gitdir = os.path.join(os.path.dirname(gitdir), line[8:])
+    commondir = gitdir
+    commondir_file = os.path.join(gitdir, 'commondir')
+    if os.path.exists(commondir_file):
+        with open(commondir_file) as fh:
+            commondir = os.path.join(gitdir, fh.readline().rstrip('\r\n'))
+    return gitdir, commondir
+
+
+def _read_git_branch():
+    """Get the current git branch by reading HEAD directly, or None if it
+       cannot be determined that way"""
+    try:
+        with open(os.path.join(get_git_dirs()[0], 'HEAD')) as fh:
+            head = fh.readline().rstrip('\r\n')
+    except (OSError, ValueError):
+        return None
+    if head.startswith('ref: refs/heads/'):
+        return head[16:]
+
+
+def read_git_remote_url(gitdir):
+    """Get the URL of the origin remote by reading the config file in
+       `gitdir` directly, or None if it cannot be determined that way"""
+    config = configparser.ConfigParser(strict=False, allow_no_value=True,
+                                       interpolation=None)
+    try:
+        config.read(os.path.join(gitdir, 'config'))
+        return config.get('remote "origin"', 'url')
+    except configparser.Error:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_git_branch():
+    # If GIT_DIR is set, the repository is not where we would look for it
+    branch = None if 'GIT_DIR' in os.environ else _read_git_branch()
+    if branch is None:
+        # Let git handle anything more complex, e.g. a detached HEAD
+        branch = subprocess.check_output(
+            ['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+            universal_newlines=True).rstrip('\r\n')
+    return branch
+
+
+@functools.lru_cache(maxsize=None)
+def get_git_repo():
+    url = None
+    if 'GIT_DIR' not in os.environ:
+        try:
+            url = read_git_remote_url(get_git_dirs()[1])
+        except (OSError, ValueError):
+            pass
+    if url is None:
+        # Let git handle anything more complex, e.g. included config files
+        url = subprocess.check_output(
+            ['git', 'config', '--get', 'remote.origin.url'],
+            universal_newlines=True).rstrip('\r\n')
+    pth, repo = os.path.split(url)
+    if repo.endswith('.git'):
+        repo = repo[:-4]
+    return repo
+
+
+def _get_doxygen_template_cache():
+    """Get the path to the cached doxygen config template, or None.
+       This is keyed on the doxygen binary's path, size and modification
+       time, so changes if doxygen is upgraded"""
+    doxygen = shutil.which('doxygen')
+    if doxygen is None:
+        return None
+    # Hashing the binary itself could take longer than running doxygen
+    doxygen = os.path.realpath(doxygen)
+    st = os.stat(doxygen)
+    sha1 = hashlib.sha1(('%s %d %d' % (doxygen, st.st_size,
+                                       st.st_mtime_ns)).encode())
+    cachedir = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cachedir, 'tutorial_tools',
+                        'doxyfile-template-%s' % sha1.hexdigest())
+
+
+def get_doxygen_template():
+    """Get the lines of doxygen's default configuration file, running
+       doxygen only if they have not already been cached"""
+    cache = _get_doxygen_template_cache()
+    if cache and os.path.exists(cache):
+        with open(cache) as fh:
+            return fh.readlines()
+    p = subprocess.run(['doxygen', '-s', '-g', '-'], stdout=subprocess.PIPE,
+                       universal_newlines=True)
+    if p.returncode != 0:
+        raise OSError("doxygen failed")
+    lines = p.stdout.splitlines(keepends=True)
+    if cache:
+        # Failure to write the cache is not fatal; use a temporary file so
+        # that a concurrent build never sees a partial template
+        try:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(cache),
+                                             delete=False) as fh:
+                fh.writelines(lines)
+            os.replace(fh.name, cache)
+        except OSError:
+            pass
+    return lines
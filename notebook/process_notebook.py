@@ -11,9 +11,34 @@ import time
 import argparse
 import posixpath
 import subprocess
-import xml.etree.ElementTree as ET
+import hashlib
+import pickle
+import functools
+import shutil
+import tempfile
+import mmap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from inventory import InventoryFile
+# Code shared with make-docs.py lives in the doxygen directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'doxygen'))
+from tutorial_common import (find_toplevel, get_git_branch, get_git_repo,
+                             get_doxygen_template)
 import urllib.request
+import urllib.error
+try:
+    # lxml is much faster than ElementTree at parsing large tag files
+    from lxml import etree as ET
+    _iterparse_args = {'tag': 'compound', 'huge_tree': True,
+                       'remove_blank_text': True}
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _iterparse_args = {}
+try:
+    # orjson is much faster than json at reading notebooks
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # Latest IMP stable release
@@ -23,17 +48,16 @@ IMP_STABLE_RELEASE = '2.22.0'
 DOXDIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                       '..', 'doxygen'))
 
-# Top of repository
-def _get_topdir():
-    parents = 0
-    path = '.git'
-    while not os.path.exists(path):
-        path = os.path.join('..', path)
-        parents += 1
-        if parents > 20:
-            raise ValueError("Could not determine top directory of repository")
-    return path[:-4]
-TOPDIR = os.path.abspath(_get_topdir())
+@functools.lru_cache(maxsize=None)
+def get_topdir():
+    """Get the top directory of the repository (only on first use, so
+       that e.g. --help does not need to find it)"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--show-toplevel'], universal_newlines=True,
+            stderr=subprocess.DEVNULL).rstrip('\r\n')
+    except (OSError, subprocess.CalledProcessError):
+        return find_toplevel()
 
 # Template prefix
 TEMPLATE = ".template."
@@ -41,6 +65,13 @@ TEMPLATE = ".template."
 # Cache directory
 CACHE = ".cache"
 
+@functools.lru_cache(maxsize=None)
+def _get_source_hash():
+    """Get a hash of this script, so that any change to the tag file
+       parser also invalidates cached refs"""
+    with open(__file__, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
 
 def file_age(fname):
     """Return time in seconds since `fname` was last changed"""
@@ -48,29 +79,117 @@ def file_age(fname):
 
 
 def get_cached_url(url, local):
-    if not os.path.exists(CACHE):
-        os.mkdir(CACHE)
+    # CACHE is relative to the current directory, so we can't just remember
+    # that we already made it
+    os.makedirs(CACHE, exist_ok=True)
     fname = os.path.join(CACHE, local)
-    # Use file if it already exists and is less than a day old
-    if not os.path.exists(fname) or file_age(fname) > 86400:
-        # python.org doesn't allow retrieving objects.inv without a user-agent
-        # string, so provide one
-        r = urllib.request.Request(url, headers={'User-Agent': 'urllib'})
+    # HTTP headers from the last download; the mtime of this file is the
+    # last time we checked with the server
+    headers_fname = fname + '.headers'
+    have_headers = os.path.exists(headers_fname)
+    have_file = os.path.exists(fname)
+    # Use file if it already exists and was checked less than a day ago
+    if have_file and file_age(headers_fname if have_headers
+                              else fname) <= 86400:
+        return fname
+    # python.org doesn't allow retrieving objects.inv without a user-agent
+    # string, so provide one
+    headers = {'User-Agent': 'urllib'}
+    if have_file and have_headers:
+        # Ask the server to only send the file if it has changed
+        with open(headers_fname) as fh:
+            old_headers = json.load(fh)
+        if old_headers.get('ETag'):
+            headers['If-None-Match'] = old_headers['ETag']
+        if old_headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = old_headers['Last-Modified']
+    r = urllib.request.Request(url, headers=headers)
+    try:
         response = urllib.request.urlopen(r)
-        with open(fname, 'wb') as fh:
-            fh.write(response.read())
+    except urllib.error.HTTPError as err:
+        if err.code != 304:
+            raise
+        # Not modified; leave the file (and its mtime) alone, and just
+        # record that we checked
+        os.utime(headers_fname, None)
+        return fname
+    # Write to a temporary file first, so that other processes never
+    # see a partially-written file
+    tmpname = '%s.%d' % (fname, os.getpid())
+    with open(tmpname, 'wb') as fh:
+        fh.write(response.read())
+    os.replace(tmpname, fname)
+    new_headers = dict((h, response.headers[h])
+                       for h in ('ETag', 'Last-Modified')
+                       if response.headers[h])
+    with open(tmpname, 'w') as fh:
+        json.dump(new_headers, fh)
+    os.replace(tmpname, headers_fname)
     return fname
 
 
+def _get_child_text(elem, tags):
+    """Get a dict of the text of the first child of `elem` with each of
+       the given tags, in a single pass over the children"""
+    text = {}
+    for child in elem:
+        if child.tag in tags and child.tag not in text:
+            text[child.tag] = child.text
+            if len(text) == len(tags):
+                break
+    return text
+
+
 class RefLinks(object):
     """Handle doxygen-style @ref links in markdown"""
-    include_re = re.compile(r'%%include\s+([^\s)]+)')
     backtick_link = re.compile(r'``([^\s`]+)``')
     ref_link = re.compile(r'@ref\s+([^\s)]+)')
+    # Any of the above, so that each line need only be scanned once
+    any_link = re.compile(r'%%include\s+(?P<include>[^\s)]+)'
+                          r'|``(?P<backtick>[^\s`]+)``'
+                          r'|@ref\s+(?P<ref>[^\s)]+)')
 
     def __init__(self):
         #: Mapping from identifier to URL
         self.refs = {}
+        # A.B aliases for A::B identifiers in refs
+        self._dotted_refs = {}
+        # Results of fix_links for each line seen so far
+        self._fixed_lines = {}
+        #: URLs of intersphinx inventories already read
+        self.intersphinx_urls = set()
+
+    def copy(self):
+        """Return a copy of this object, with its own set of refs"""
+        rl = RefLinks()
+        rl.refs = self.refs.copy()
+        rl._dotted_refs = self._dotted_refs.copy()
+        return rl
+
+    def load_or_parse(self, tag_files):
+        """Get @ref targets from the given doxygen tag files, which are
+           (filename, urltop) pairs. The results are cached on disk, so that
+           the tag files need only be parsed again if they change."""
+        h = hashlib.sha1(_get_source_hash().encode())
+        for filename, urltop in tag_files:
+            h.update(('%s %s %s\n' % (filename, os.stat(filename).st_mtime,
+                                      urltop)).encode())
+        cache = os.path.join(CACHE, 'refs-%s.pkl' % h.hexdigest())
+        if os.path.exists(cache):
+            with open(cache, 'rb') as fh:
+                self.refs = pickle.load(fh)
+            self._add_dotted_aliases()
+            return
+        for filename, urltop in tag_files:
+            self.parse_doxygen_tag_file(filename, urltop)
+        # Remove any outdated cache files
+        for old in glob.glob(os.path.join(CACHE, 'refs-*.pkl')):
+            os.unlink(old)
+        os.makedirs(CACHE, exist_ok=True)
+        tmpname = '%s.%d' % (cache, os.getpid())
+        with open(tmpname, 'wb') as fh:
+            pickle.dump(self.refs, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, cache)
 
     def parse_python_inventory_file(self, filename, urltop):
         """Read a Python inventory (intersphinx) file to get @ref targets"""
@@ -80,52 +199,77 @@ class RefLinks(object):
             if k.startswith('py:'):
                 for ident, info in v.items():
                     self.refs[ident] = info[2]
+        self._add_dotted_aliases()
 
     def parse_doxygen_tag_file(self, filename, urltop):
         """Read a doxygen tag file to get @ref targets"""
-        root = ET.parse(filename).getroot()
-        # Get URLs for every class and namespace:
-        for c in root:
-            if (c.tag == 'compound'
-                and c.attrib.get('kind') in ('class', 'namespace')):
-                name = c.find('name').text
-                base = c.find('base')
-                if base is not None:
-                    base = base.text
-                url = urltop + c.find('filename').text
+        # Process each top-level compound as soon as it has been read, then
+        # discard it, so that the whole file is never held in memory
+        for event, c in ET.iterparse(filename, events=('end',),
+                                     **_iterparse_args):
+            # ElementTree reports every element, not just compounds
+            if c.tag != 'compound':
+                continue
+            kind = c.get('kind')
+            # Get URLs for every class and namespace:
+            if kind in ('class', 'namespace'):
+                text = _get_child_text(c, ('name', 'base', 'filename'))
+                name = text['name']
+                base = text.get('base')
+                url = urltop + text['filename']
                 self.refs[name] = url
                 self._add_member_tags(c, name, base, urltop)
-            elif c.tag == 'compound' and c.attrib.get('kind') == 'page':
+            elif kind == 'page':
                 self._add_page_tags(c, urltop)
-            elif c.tag == 'compound' and c.attrib.get('kind') == 'file':
+            elif kind == 'file':
                 self._add_file_tags(c, urltop)
+            c.clear()
+            if hasattr(c, 'getprevious'):
+                # lxml also lets us free the compounds we already processed
+                while c.getprevious() is not None:
+                    del c.getparent()[0]
+        self._add_dotted_aliases()
+
+    def _add_dotted_aliases(self):
+        """Make each A::B identifier also available as A.B, so that
+           Python-style @ref links need only a single lookup"""
+        self._dotted_refs = {k.replace('::', '.'): v
+                             for k, v in self.refs.items()
+                             if '::' in k and '.' not in k}
+        # Links may now resolve differently
+        self._fixed_lines.clear()
 
     def _add_file_tags(self, page, urltop):
         """Add doxygen tags for file objects"""
         namespace = None
+        # Get the file's own name and filename in the same pass
+        text = {}
         for child in page:
-            if child.tag == 'namespace':
+            tag = child.tag
+            if tag == 'namespace':
                 namespace = child.text
-            if (namespace and child.tag == 'member'
-                and child.attrib.get('kind') == 'typedef'):
-                name = child.find('name').text
-                anchorfile = child.find('anchorfile').text
-                url = urltop + anchorfile + '#' + child.find('anchor').text
-                self.refs[namespace + '::' + name] = url
-        name = page.find('name').text
+            elif tag in ('name', 'filename') and tag not in text:
+                text[tag] = child.text
+            if (namespace and tag == 'member'
+                and child.get('kind') == 'typedef'):
+                member = _get_child_text(child,
+                                         ('name', 'anchorfile', 'anchor'))
+                url = urltop + member['anchorfile'] + '#' + member['anchor']
+                self.refs[namespace + '::' + member['name']] = url
+        name = text['name']
         if name.endswith('.h'):
             fullname = 'IMP/' + name
-            filename = page.find('filename').text
-            self.refs[fullname] = urltop + filename + '.html'
+            self.refs[fullname] = urltop + text['filename'] + '.html'
 
     def _add_page_tags(self, page, urltop):
         """Add doxygen tags for page anchors"""
-        name = page.find('name').text
-        filename = page.find('filename').text
-        self.refs[name] = urltop + filename + '.html'
+        # Add the page itself first, so that an anchor with the same name
+        # as the page takes precedence
+        text = _get_child_text(page, ('name', 'filename'))
+        self.refs[text['name']] = urltop + text['filename'] + '.html'
         for child in page:
             if child.tag == 'docanchor':
-                url = urltop + child.attrib['file'] + '.html#' + child.text
+                url = urltop + child.get('file') + '.html#' + child.text
                 self.refs[child.text] = url
 
     def _add_member_tags(self, cls, clsname, clsbase, urltop):
@@ -142,10 +286,11 @@ class RefLinks(object):
             if f.startswith('class') and f.endswith('.html'):
                 return f[5:-5].replace('_1_1', '::').replace('__', '_')
         for meth in cls:
-            if (meth.tag == 'member' and meth.attrib.get('kind') == 'function'):
-                methname = meth.find('name').text
-                anchorfile = meth.find('anchorfile').text
-                url = (urltop + anchorfile + '#' + meth.find('anchor').text)
+            if (meth.tag == 'member' and meth.get('kind') == 'function'):
+                text = _get_child_text(meth, ('name', 'anchorfile', 'anchor'))
+                methname = text['name']
+                anchorfile = text['anchorfile']
+                url = (urltop + anchorfile + '#' + text['anchor'])
                 self.refs[clsname + '::' + methname] = url
                 cls_for_file = _get_class_for_file(anchorfile)
                 if clsbase and anchorfile.endswith(base_suffix):
@@ -154,7 +299,7 @@ class RefLinks(object):
                     self.refs[cls_for_file + '::' + methname] = url
 
     def _replace_backtick_link(self, m):
-        txt = m.group(1)
+        txt = m.group(m.lastindex)
         if txt.startswith('~'):
             short_txt = txt.split('.')[-1].split('::')[-1]
             return '[%s](@ref %s)' % (short_txt, txt[1:])
@@ -162,140 +307,216 @@ class RefLinks(object):
             return '[%s](@ref %s)' % (txt, txt)
 
     def _replace_ref_link(self, m):
-        ref = m.group(1)
-        link = self.refs.get(ref) or self.refs.get(ref.replace('.', '::'))
+        ref = m.group(m.lastindex)
+        link = self.refs.get(ref) or self._dotted_refs.get(ref)
+        if not link and '.' in ref:
+            link = self.refs.get(ref.replace('.', '::'))
         if not link:
             raise ValueError("Bad @ref link to %s" % ref)
         return link
 
     def _include_file(self, m):
-        filename = m.group(1)
+        filename = m.group(m.lastindex)
         with open(filename) as fh:
             return fh.read()
 
+    def _replace_any_link(self, m):
+        if m.lastgroup == 'include':
+            # Links in included files are also handled (but not includes)
+            c = self._include_file(m)
+            c = self.backtick_link.sub(self._replace_backtick_link, c)
+            return self.ref_link.sub(self._replace_ref_link, c)
+        elif m.lastgroup == 'backtick':
+            return self.ref_link.sub(self._replace_ref_link,
+                                     self._replace_backtick_link(m))
+        else:
+            return self._replace_ref_link(m)
+
     def fix_links(self, c):
         """Modify and return `c` to replace any @ref links with URLs,
            and any %%include magics with file contents"""
-        c = re.sub(self.include_re, self._include_file, c)
-        c = re.sub(self.backtick_link, self._replace_backtick_link, c)
-        return re.sub(self.ref_link, self._replace_ref_link, c)
+        # Templates repeat many lines, so only process each one once
+        fixed = self._fixed_lines.get(c)
+        if fixed is None:
+            fixed = self._fixed_lines[c] = self.any_link.sub(
+                self._replace_any_link, c)
+        return fixed
+
+
+# Translation table to make a local filename from a URL
+_url_to_local = str.maketrans('', '', ':/')
+
+
+def get_intersphinx_inventory(url):
+    """Get a local copy of the intersphinx inventory for docs at `url`"""
+    objfile_url = posixpath.join(url, 'objects.inv')
+    return get_cached_url(url=objfile_url,
+                          local=objfile_url.translate(_url_to_local))
+
+
+def prefetch_intersphinx(cells):
+    """Download all intersphinx inventories used by the given cells at
+       once, so that we only wait for the slowest one"""
+    urls = set(c.split()[1] for cell in cells
+               if cell['cell_type'] == 'markdown'
+               for c in cell['source'] if c.startswith('%intersphinx'))
+    if len(urls) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(urls), 8)) as executor:
+            list(executor.map(get_intersphinx_inventory, urls))
 
 
 def patch_source(source, rl):
     for c in source:
-        if c.startswith('%gencelloutputs'):
+        # Most lines aren't magics, so check for that case first
+        if not c.startswith('%'):
+            yield rl.fix_links(c)
+        elif c.startswith('%gencelloutputs'):
             pass
         elif c.startswith('%intersphinx'):
             url = c.split()[1]
-            objfile_url = posixpath.join(url, 'objects.inv')
-            objfile = get_cached_url(url=objfile_url,
-                local=objfile_url.replace(':', '').replace('/', ''))
-            rl.parse_python_inventory_file(objfile, url)
+            # Don't reread the same inventory if it is used more than once
+            if url not in rl.intersphinx_urls:
+                rl.intersphinx_urls.add(url)
+                objfile = get_intersphinx_inventory(url)
+                rl.parse_python_inventory_file(objfile, url)
         else:
             yield rl.fix_links(c)
 
 
 _file_link_re = re.compile(r'@file\s+([^\s)]+)')
-non_jupyter_constructs = re.compile('#?%%(html|nb|colab)(exclude|only)')
-jupyter_anchor_re = re.compile(r'\s*\{#([^\s}]+)\}')
+# Replacement templates for @file links in notebooks and markdown
+_ipynb_link_repl = r'\1.ipynb'
+_html_link_repl = r'\1.html'
+non_jupyter_constructs = re.compile(r'#?%%(html|nb|colab)(exclude|only)')
+# Cheap test for lines that could possibly match non_jupyter_constructs
+_non_jupyter_prefixes = ('%%', '#%%')
+jupyter_anchor_re = re.compile(r'\s*\{#([^\s}]+)\}', re.ASCII)
+_jupyter_anchor_repl = r'<a id="\1"></a>'
 def patch_jupyter(source, rl, toc, is_markdown):
+    non_jupyter_match = non_jupyter_constructs.match
     if is_markdown:
+        anchor_sub = jupyter_anchor_re.sub
+        file_link_sub = _file_link_re.sub
         for c in source:
             if '[TOC]' in c:
                 for md in toc.get_markdown():
                     yield md
             else:
-                if not non_jupyter_constructs.match(c):
-                    nc = re.sub(jupyter_anchor_re, '<a id="\\1"></a>', c)
-                    nc = _file_link_re.sub('\\1.ipynb', nc)
+                if (not c.startswith(_non_jupyter_prefixes)
+                        or not non_jupyter_match(c)):
+                    nc = anchor_sub(_jupyter_anchor_repl, c)
+                    if '@file' in nc:
+                        nc = file_link_sub(_ipynb_link_repl, nc)
                     yield nc
     else:
         for c in source:
-            if not non_jupyter_constructs.match(c):
+            if (not c.startswith(_non_jupyter_prefixes)
+                    or not non_jupyter_match(c)):
                 yield c
 
 
 _triple_backtick_re = re.compile(r'```(\S+)')
+# Jupyter markdown expects a language name, e.g. ```python
+# but Doxygen expects a file extension, e.g. ```py
+# so map one to the other
+_lang_replace = {'python': 'py', 'c++': 'cpp'}
+def _tb_sub(m):
+    lang = m.group(1)
+    return '```' + _lang_replace.get(lang, lang)
+
 def write_cell(cell, fh, strip_magic=False):
     all_contents = []
-    def tb_sub(m):
-        # Jupyter markdown expects a language name, e.g. ```python
-        # but Doxygen expects a file extension, e.g. ```py
-        # so map one to the other
-        lang = m.group(1)
-        lang_replace = {'python': 'py', 'c++': 'cpp'}
-        lang = lang_replace.get(lang, lang)
-        return '```' + lang
+    non_jupyter_match = non_jupyter_constructs.match
+    file_link_sub = _file_link_re.sub
+    triple_backtick_sub = _triple_backtick_re.sub
     for s in cell['source']:
         # Colab-only code cells shouldn't end up in the .py output
         if s.startswith('#%%colabonly'):
+            fh.write("".join(all_contents))
             return []
-        if (not re.match('#?%%(html|nb|colab)(exclude|only)', s)
+        if ((not s.startswith(_non_jupyter_prefixes)
+             or not non_jupyter_match(s))
             and not s.startswith('%matplotlib')):
             # Display !foxs as foxs and %cd as cd in .md output
-            if strip_magic and (s.startswith('!') or s.startswith('%')):
+            if strip_magic and s.startswith(('!', '%')):
                 s = s[1:]
-            contents = _file_link_re.sub('\\1.html', s)
-            contents = _triple_backtick_re.sub(tb_sub, contents)
-            fh.write(contents)
+            if '@file' in s:
+                contents = file_link_sub(_html_link_repl, s)
+            else:
+                contents = s
+            if '```' in contents:
+                contents = triple_backtick_sub(_tb_sub, contents)
             all_contents.append(contents)
-    fh.write('\n')
+    # Write the whole cell at once
+    fh.write("".join(all_contents) + '\n')
     return all_contents
 
 
+# Key in a cell output dict holding the raw (not base64-encoded) PNG data
+# for a plot; removed before the notebook is written
+RAW_PNG_KEY = '_raw_png'
+
+
 class CellOutputWriter(object):
     def __init__(self, topdir):
         self.imgdir = os.path.join(topdir, 'matplotlib')
         # Make sure img files have unique names
         self.counter = 0
+        # Only make the directory once, and only if we have any images
+        self._imgdir_made = False
 
-    def write_image(self, contents):
+    def write_image(self, contents, raw=None):
+        """Write a base64-encoded PNG image; if the decoded PNG data is
+           already available, it can be passed as `raw` instead"""
         self.counter += 1
-        if not os.path.exists(self.imgdir):
-            os.makedirs(self.imgdir)
+        if not self._imgdir_made:
+            os.makedirs(self.imgdir, exist_ok=True)
+            self._imgdir_made = True
         img = "%d.png" % self.counter
         with open(os.path.join(self.imgdir, img), 'wb') as fh:
-            fh.write(base64.b64decode(contents))
+            fh.write(base64.b64decode(contents) if raw is None else raw)
         return img
 
     def write(self, cell, fh):
+        parts = []
         for out in cell['outputs']:
             if out['output_type'] == 'stream':
-                fh.write('<div class="output">\n')
-                fh.write('Output\n')
-                fh.write('\\verbatim\n')
-                fh.write("".join(out['text']))
-                fh.write('\\endverbatim\n')
-                fh.write('</div>\n')
+                parts.append('<div class="output">\nOutput\n\\verbatim\n')
+                parts.extend(out['text'])
+                parts.append('\\endverbatim\n</div>\n')
             elif out['output_type'] == 'display_data':
                 if 'image/png' in out['data']:
-                    img = self.write_image(out['data']['image/png'])
-                    fh.write('<div class="output">\n')
-                    fh.write('<img src="matplotlib/%s" />\n' % img)
-                    fh.write('</div>\n')
-
-
-def get_cell_subset(cells, excludestr, onlytype):
+                    img = self.write_image(out['data']['image/png'],
+                                           out.pop(RAW_PNG_KEY, None))
+                    parts.append('<div class="output">\n'
+                                 '<img src="matplotlib/%s" />\n'
+                                 '</div>\n' % img)
+        fh.write("".join(parts))
+
+
+_only_re = re.compile(r'%%(\S+)only')
+def get_cell_subsets(cells):
+    """Get lists of the cells to include in the HTML, notebook and Colab
+       outputs, as determined by %%*exclude or %%*only in their first line.
+       All three lists are built with a single pass over the cells."""
+    only_search = _only_re.search
+    html, nb, colab = subsets = ([], [], [])
+    outputs = list(zip(('html', 'nb', 'colab'), subsets))
     for cell in cells:
-        if not cell['source'] or excludestr not in cell['source'][0]:
-            m = re.search(r'%%(\S+)only', cell['source'][0])
-            if not m or m.group(1) == onlytype:
-                yield cell
-
-
-def get_only_html_cells(cells):
-    return get_cell_subset(cells, excludestr='%%htmlexclude',
-                           onlytype='html')
-
-
-def get_only_notebook_cells(cells):
-    return get_cell_subset(cells, excludestr='%%nbexclude',
-                           onlytype='nb')
-
-
-def get_only_colab_cells(cells):
-    return get_cell_subset(cells, excludestr='%%colabexclude',
-                           onlytype='colab')
+        source = cell['source']
+        first = source[0] if source else ''
+        if '%%' not in first:
+            # Most cells are included in every output
+            html.append(cell)
+            nb.append(cell)
+            colab.append(cell)
+            continue
+        m = only_search(first)
+        for onlytype, subset in outputs:
+            if ('%%' + onlytype + 'exclude' not in first
+                    and (not m or m.group(1) == onlytype)):
+                subset.append(cell)
+    return subsets
 
 
 class ScriptWriter(object):
@@ -314,7 +535,7 @@ class ScriptWriter(object):
         if not code_cells:
             return
         fname = self.get_filename(root)
-        with open(fname, 'w') as fh:
+        with open(fname, 'w', buffering=1 << 16) as fh:
             self.write_header(fh)
             first = True
             for cell in code_cells:
@@ -353,6 +574,8 @@ class PythonScriptWriter(ScriptWriter):
             p = PlotWrapper(plt.show, self)
             plt.show = p
             self._context = {}
+            # Compiled code for each cell, keyed by source
+            self._code_cache = {}
 
     def write_header(self, fh):
         fh.write("#!/usr/bin/env python3\n\n")
@@ -365,6 +588,15 @@ class PythonScriptWriter(ScriptWriter):
         self.plt.savefig(f)
         return f.getvalue()
 
+    def _compile(self, src):
+        code = self._code_cache.get(src)
+        if code is None:
+            # Give each cell a name, for more readable tracebacks
+            code = compile(src, '<cell-%d>' % (len(self._code_cache) + 1),
+                           'exec')
+            self._code_cache[src] = code
+        return code
+
     def process_contents(self, contents, cell):
         if not self.output:
             return
@@ -374,7 +606,7 @@ class PythonScriptWriter(ScriptWriter):
         sio = io.StringIO()
         try:
             sys.stdout = sio
-            exec("".join(contents), self._context)
+            exec(self._compile("".join(contents)), self._context)
         finally:
             sys.stdout = o
         if self.plot:
@@ -383,7 +615,9 @@ class PythonScriptWriter(ScriptWriter):
             cell['outputs'] = [
                     {'data': { "image/png": b64contents},
                      'metadata': {'needs_background': 'light'},
-                     'output_type': 'display_data'}]
+                     'output_type': 'display_data',
+                     # Keep the raw data too, so it needn't be decoded again
+                     RAW_PNG_KEY: plot_contents}]
             self.plt.close('all')
         else:
             output = sio.getvalue().rstrip('\r\n').split("\n")
@@ -401,25 +635,30 @@ class BashScriptWriter(ScriptWriter):
 
 
 class TableOfContents(object):
-    anchor_re = re.compile(r'(#+)\s+(.*?)\s*\{#([^\s}]+)\}')
-    noanchor_re = re.compile(r'(#+)\s+(.*?)\s*$')
+    # Markdown headings only use ASCII whitespace, so skip Unicode lookups
+    anchor_re = re.compile(r'(#+)\s+(.*?)\s*\{#([^\s}]+)\}', re.ASCII)
+    # Any heading, with the anchor (if present) in group 3
+    heading_re = re.compile(r'(#+)\s+(.*?)\s*(?:\{#([^\s}]+)\}|$)',
+                            re.ASCII)
 
     def __init__(self, filenum):
         self._auto_toc = 0 # autogenerated anchors for titles without them
         self.filenum = filenum
-        self.entries = [] # list of (level, title, anchor) tuples
+        # Level, title and anchor of each entry
+        self.levels = []
+        self.titles = []
+        self.anchors = []
+        self._last_level = 0 # level of the last entry, or 0 if none
 
     def add_missing_anchors(self, source):
         """Auto-generate anchors if they're missing"""
+        heading_match = self.heading_re.match
         for s in source:
-            if not self.anchor_re.match(s):
-                m = self.noanchor_re.match(s)
-                if m:
-                    self._auto_toc += 1
-                    anchor = "autotoc%dv%d" % (self.filenum, self._auto_toc)
-                    yield '%s %s {#%s}' % (m.group(1), m.group(2), anchor)
-                else:
-                    yield s
+            m = heading_match(s) if s.startswith('#') else None
+            if m and m.group(3) is None:
+                self._auto_toc += 1
+                anchor = "autotoc%dv%d" % (self.filenum, self._auto_toc)
+                yield '%s %s {#%s}' % (m.group(1), m.group(2), anchor)
             else:
                 yield s
 
@@ -429,48 +668,95 @@ class TableOfContents(object):
             return
         def get_sections(source):
             for s in source:
-                m = self.anchor_re.match(s)
+                m = s.startswith('#') and self.anchor_re.match(s)
                 if m:
                     yield len(m.group(1)), m.group(2), m.group(3)
         for level, title, anchor in get_sections(source):
-            if self.entries and level > self.entries[-1][0] + 1:
+            if self._last_level and level > self._last_level + 1:
                 raise ValueError("A level-%d heading (%s) cannot follow a "
                     "level-%d heading (%s)"
-                    % (level, title, self.entries[-1][0], self.entries[-1][1]))
-            elif not self.entries and level != 1:
+                    % (level, title, self._last_level, self.titles[-1]))
+            elif not self._last_level and level != 1:
                 raise ValueError(
                     "Top-level section (%s) is not a level one heading "
                     "(use '# title {#anchor}')" % title)
-            self.entries.append((level, title, anchor))
+            self.levels.append(level)
+            self.titles.append(title)
+            self.anchors.append(anchor)
+            self._last_level = level
 
     def get_markdown(self):
         yield "**Table of contents**\n"
         yield "\n"
-        for level, title, anchor in self.entries:
+        for level, title, anchor in zip(self.levels, self.titles,
+                                        self.anchors):
             yield '%s- [%s](#%s)\n' % (' ' * level, title, anchor)
 
 
+def _template_runs_code(root):
+    """Return True if the template might use %gencelloutputs"""
+    with open('%s%s.ipynb' % (TEMPLATE, root)) as fh:
+        return '%gencelloutputs' in fh.read()
+
+
+def read_notebook(fname):
+    """Read and return the JSON contents of a Jupyter notebook"""
+    if orjson:
+        with open(fname, 'rb') as fh:
+            return orjson.loads(fh.read())
+    else:
+        with open(fname) as fh:
+            return json.load(fh)
+
+
+def write_notebook(fname, j):
+    """Write the JSON contents `j` of a Jupyter notebook"""
+    # Always use json here, not orjson, which formats some values (such as
+    # non-ASCII text) differently; the output should not depend on whether
+    # orjson is installed. json.dump would make a separate write call for
+    # each JSON token, so format the whole notebook first.
+    with open(fname, 'w') as fh:
+        fh.write(json.dumps(j, indent=2, separators=(',', ': ')))
+
+
 class FileGenerator(object):
-    def __init__(self, tags):
-        self.tags = tags
+    def __init__(self, rl):
+        # RefLinks populated from the doxygen tag files; each template
+        # gets its own copy, since %intersphinx adds to it
+        self.rl = rl
         self._file_counter = 0
 
     def generate_files(self, root, output_writer):
         self._file_counter += 1
-        _generate_files(root, self.tags, self._file_counter, output_writer)
-
-
-def _generate_files(root, tags, file_counter, output_writer):
+        _generate_files(root, self.rl.copy(), self._file_counter,
+                        output_writer)
+
+    def generate_all_files(self, roots, output_writer):
+        """Generate files for every template in `roots`.
+           Templates are independent, so are handled in parallel unless
+           any of them needs to run its code to generate cell outputs
+           (which shares the output writer and plotting state)."""
+        if len(roots) < 2 or any(_template_runs_code(r) for r in roots):
+            for root in roots:
+                self.generate_files(root, output_writer)
+            return
+        with ProcessPoolExecutor() as executor:
+            futures = []
+            for root in roots:
+                self._file_counter += 1
+                futures.append(executor.submit(
+                    _generate_files, root, self.rl, self._file_counter,
+                    output_writer))
+            for f in futures:
+                f.result()
+
+
+def _generate_files(root, rl, file_counter, output_writer):
     gen_output = False
-    rl = RefLinks()
-    for t in tags:
-        rl.parse_doxygen_tag_file(t.xml_filename, t.doctop)
-
     toc = TableOfContents(file_counter)
 
     # Read in the template
-    with open('%s%s.ipynb' % (TEMPLATE, root)) as fh:
-        j = json.load(fh)
+    j = read_notebook('%s%s.ipynb' % (TEMPLATE, root))
 
     # Make sure all outputs are empty
     for cell in j['cells']:
@@ -481,6 +767,7 @@ def _generate_files(root, tags, file_counter, output_writer):
     language = kernel['language']
 
     # Handle our custom magics and @ref links
+    prefetch_intersphinx(j['cells'])
     for cell in j['cells']:
         if cell['cell_type'] == 'markdown':
             cell['source'] = list(toc.add_missing_anchors(cell['source']))
@@ -489,6 +776,8 @@ def _generate_files(root, tags, file_counter, output_writer):
                                            for c in cell['source'])
             cell['source'] = list(patch_source(cell['source'], rl))
 
+    html_cells, nb_cells, colab_cells = get_cell_subsets(j['cells'])
+
     # Write plain Python or Bash script
     # This also populates cell outputs if gen_output is set
     writer = {'python': PythonScriptWriter,
@@ -496,15 +785,17 @@ def _generate_files(root, tags, file_counter, output_writer):
     writer.write(root, j['cells'])
 
     # Write markdown suitable for processing with doxygen
-    with open('%s.md' % root, 'w') as fh:
-        for cell in get_only_html_cells(j['cells']):
-            if cell['cell_type'] == 'markdown':
+    with open('%s.md' % root, 'w', buffering=1 << 16) as fh:
+        write = fh.write
+        for cell in html_cells:
+            cell_type = cell['cell_type']
+            if cell_type == 'markdown':
                 write_cell(cell, fh)
-                fh.write('\n')
-            elif cell['cell_type'] == 'code':
-                fh.write('\\code{.py}\n')
+                write('\n')
+            elif cell_type == 'code':
+                write('\\code{.py}\n')
                 write_cell(cell, fh, strip_magic=True)
-                fh.write('\\endcode\n')
+                write('\\endcode\n')
                 if gen_output and cell['outputs']:
                     output_writer.write(cell, fh)
 
@@ -513,27 +804,27 @@ def _generate_files(root, tags, file_counter, output_writer):
         # from the JSON
         j['cells'] = cells
         for cell in j['cells']:
-            cell['source'] = list(
-                patch_jupyter(cell['source'], rl, toc,
+            source = cell['source']
+            new_source = list(
+                patch_jupyter(source, rl, toc,
                               cell['cell_type'] == 'markdown'))
+            # patch_jupyter yields unmodified lines as-is, so only replace
+            # the source list if something actually changed
+            if (len(new_source) != len(source)
+                    or any(n is not o for n, o in zip(new_source, source))):
+                cell['source'] = new_source
+            # Raw image data isn't part of the notebook format
+            for out in cell.get('outputs', ()):
+                out.pop(RAW_PNG_KEY, None)
 
         # Write Jupyter notebook
-        with open(fname, 'w') as fh:
-            json.dump(j, fh, indent=2)
+        write_notebook(fname, j)
 
-    nb_cells = list(get_only_notebook_cells(j['cells']))
-    colab_cells = list(get_only_colab_cells(j['cells']))
     write_jupyter('%s.ipynb' % root, nb_cells)
     if colab_cells != nb_cells:
         write_jupyter('%s-colab.ipynb' % root, colab_cells)
 
 
-def get_git_branch():
-    return subprocess.check_output(['git', 'rev-parse', '--abbrev-ref',
-                                    'HEAD'],
-                                   universal_newlines=True).rstrip('\r\n')
-
-
 class TagFile(object):
     """Represent a doxygen XML tag file"""
 
@@ -557,8 +848,9 @@ class TagFile(object):
 
 def get_tag_files(imp_version):
     tags = [TagFile(doctype, imp_version) for doctype in ('manual', 'ref')]
-    for t in tags:
-        t.download()
+    # Fetch all files at once, so that we only wait for the slowest one
+    with ThreadPoolExecutor(max_workers=len(tags)) as executor:
+        list(executor.map(lambda t: t.download(), tags))
     return tags
 
 
@@ -577,45 +869,31 @@ def parse_args():
 def make_doxyfile(root, tags):
     tagfiles = " ".join(("%s=%s" % (t.xml_filename, t.doctop)) for t in tags)
     title = "IMP Tutorial"
-    # Generate doxygen template
-    p = subprocess.Popen(['doxygen', '-s', '-g', '-'], stdout=subprocess.PIPE,
-                         universal_newlines=True)
-    # Substitute in our custom config
+    # Our custom config, keyed by doxygen setting name
+    replacements = {
+        'LAYOUT_FILE': 'LAYOUT_FILE = "%s/layout.xml"\n' % DOXDIR,
+        'PROJECT_NAME': 'PROJECT_NAME = "%s"\n' % title,
+        'INPUT': 'INPUT = %s\n' % " ".join("%s.md" % m for m in root),
+        'SEARCHENGINE': 'SEARCHENGINE = NO\n',
+        'TOC_INCLUDE_HEADINGS': 'TOC_INCLUDE_HEADINGS = 2\n',
+        'IMAGE_PATH': 'IMAGE_PATH = .\n',
+        'EXAMPLE_PATH': 'EXAMPLE_PATH = ..\n',
+        'HTML_HEADER': 'HTML_HEADER = "%s/header.html"\n' % DOXDIR,
+        'HTML_FOOTER': 'HTML_FOOTER = "%s/footer.html"\n' % DOXDIR,
+        'GENERATE_LATEX': 'GENERATE_LATEX = NO\n',
+        'USE_MATHJAX': 'USE_MATHJAX = YES\n',
+        'MATHJAX_RELPATH':
+                'MATHJAX_RELPATH = //integrativemodeling.org/mathjax\n',
+        # Don't make links from the text (only from code samples)
+        'AUTOLINK_SUPPORT': 'AUTOLINK_SUPPORT = NO\n',
+        'TAGFILES': 'TAGFILES = %s\n' % tagfiles}
+    # Substitute our custom config into the doxygen template
+    out = []
+    for line in get_doxygen_template():
+        key = line.split(None, 1)[0] if line.strip() else ''
+        out.append(replacements.get(key, line))
     with open('Doxyfile', 'w') as fh:
-        for line in p.stdout:
-            if line.startswith('LAYOUT_FILE '):
-                line = 'LAYOUT_FILE = "%s/layout.xml"\n' % DOXDIR
-            elif line.startswith('PROJECT_NAME '):
-                line = 'PROJECT_NAME = "%s"\n' % title
-            elif line.startswith('INPUT '):
-                line = 'INPUT = %s\n' % " ".join("%s.md" % m for m in root)
-            elif line.startswith('SEARCHENGINE '):
-                line = 'SEARCHENGINE = NO\n'
-            elif line.startswith('TOC_INCLUDE_HEADINGS '):
-                line = 'TOC_INCLUDE_HEADINGS = 2\n'
-            elif line.startswith('IMAGE_PATH '):
-                line = 'IMAGE_PATH = .\n'
-            elif line.startswith('EXAMPLE_PATH '):
-                line = 'EXAMPLE_PATH = ..\n'
-            elif line.startswith('HTML_HEADER '):
-                line = 'HTML_HEADER = "%s/header.html"\n' % DOXDIR
-            elif line.startswith('HTML_FOOTER '):
-                line = 'HTML_FOOTER = "%s/footer.html"\n' % DOXDIR
-            elif line.startswith('GENERATE_LATEX '):
-                line = 'GENERATE_LATEX = NO\n'
-            elif line.startswith('USE_MATHJAX '):
-                line = 'USE_MATHJAX = YES\n'
-            elif line.startswith('MATHJAX_RELPATH '):
-                line = 'MATHJAX_RELPATH = //integrativemodeling.org/mathjax\n'
-            elif line.startswith('AUTOLINK_SUPPORT '):
-                # Don't make links from the text (only from code samples)
-                line = 'AUTOLINK_SUPPORT = NO\n'
-            elif line.startswith('TAGFILES '):
-                line = 'TAGFILES = %s\n' % tagfiles
-            fh.write(line)
-    ret = p.wait()
-    if ret != 0:
-        raise OSError("doxygen failed")
+        fh.write(''.join(out))
 
 
 def run_doxygen():
@@ -624,34 +902,27 @@ def run_doxygen():
         os.symlink('../images', 'html/images')
 
 
-def get_git_branch():
-    return subprocess.check_output(['git', 'rev-parse', '--abbrev-ref',
-                                    'HEAD'],
-                                   universal_newlines=True).rstrip('\r\n')
-
-
-def get_git_repo():
-    url = subprocess.check_output(['git', 'config', '--get',
-                                   'remote.origin.url'],
-                                   universal_newlines=True).rstrip('\r\n')
-    pth, repo = os.path.split(url)
-    if repo.endswith('.git'):
-        repo = repo[:-4]
-    return repo
-
-
 def get_pagename(filename, regex):
-    with open(filename) as fh:
-        for line in fh:
-            m = regex.search(line)
-            if m:
-                return m.group(1)
+    # Only reread the file if it has changed since we last looked at it
+    return _get_pagename(filename, os.stat(filename).st_mtime_ns, regex)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_pagename(filename, mtime, regex):
+    # Search the file with a single regex scan, which stops at the first
+    # match; `regex` must be a bytes pattern
+    with open(filename, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                m = regex.search(mm)
+                if m:
+                    return m.group(1).decode('utf-8')
     raise ValueError("Could not determine page name for file %s" % filename)
 
 
 def get_page_map():
     m = {}
-    page_name_md_re = re.compile(r'{#(\S+)}')
+    page_name_md_re = re.compile(rb'{#(\S+)}')
     for md in glob.glob("*.md"):
         if md == "README.md":
             continue
@@ -664,7 +935,7 @@ def get_page_map():
 
 def get_license():
     for fname in ('LICENSE', 'LICENSE.txt'):
-        full_fname = os.path.join(TOPDIR, fname)
+        full_fname = os.path.join(get_topdir(), fname)
         if os.path.exists(full_fname):
             with open(full_fname, 'rb') as fh:
                 return fh.read()
@@ -685,25 +956,33 @@ def get_license_link():
         return ''
 
 
+# Lines in doxygen HTML output after which we add our own content
+INIT_MENU_RE = re.compile(r"^  initMenu\('',false,false.*\n?", re.MULTILINE)
+FOOTER_RE = re.compile(r'^<hr class="footer".*\n?', re.MULTILINE)
+
+
 def patch_html(filename, repo, source, branch, license_link):
     # Path to Jupyter notebook relative to the top of the repo
-    path = os.path.relpath(os.getcwd(), TOPDIR)
+    path = os.path.relpath(os.getcwd(), get_topdir())
     edit_link = '  $(\'#main-menu\').append(\'<li style="float:right"><div id="github_edit"><a href="https://github.com/salilab/%s/blob/%s/%s/.template.%s.ipynb"><i class="fab fa-github"></i> Edit on GitHub</a></div></li>\');\n' % (repo, branch, path, source[:-3])
 
     with open(filename) as fh:
-        contents = fh.readlines()
-    patched = False
-    with open(filename, 'w') as fh:
-        for line in contents:
-            fh.write(line)
-            if line.startswith("  initMenu('',false,false"):
-                patched = True
-                fh.write(edit_link)
-            if line.startswith('<hr class="footer"'):
-                fh.write(license_link)
+        contents = fh.read()
+    # Insert the links after the relevant lines, with one scan of the file
+    contents, patched = INIT_MENU_RE.subn(
+        lambda m: m.group(0) + edit_link, contents)
     if not patched:
         raise ValueError("Failed to patch %s to add GitHub-edit link"
                          % filename)
+    if license_link:
+        contents = FOOTER_RE.sub(lambda m: m.group(0) + license_link, contents)
+    # Write to a temporary file then move it into place, so that the file is
+    # never left half-written
+    with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(filename), delete=False) as out:
+        out.write(contents)
+    shutil.copymode(filename, out.name)
+    os.replace(out.name, filename)
 
 
 def fix_menu_links(imp_version):
@@ -713,10 +992,13 @@ def fix_menu_links(imp_version):
     if imp_version == 'nightly':
         return
     fname = 'html/menudata.js'
-    with open(fname, 'r') as fh:
+    with open(fname, 'rb') as fh:
         contents = fh.read()
-    with open(fname, 'w') as fh:
-        fh.write(contents.replace('nightly', imp_version))
+    # Don't rewrite the file if there is nothing to change
+    if b'nightly' not in contents:
+        return
+    with open(fname, 'wb') as fh:
+        fh.write(contents.replace(b'nightly', imp_version.encode()))
 
 
 def fix_md_html_files():
@@ -729,10 +1011,12 @@ def add_html_links(branch):
     license_link = get_license_link()
     repo = get_git_repo()
     pagemap = get_page_map()
-    for html in glob.glob("html/*.html"):
-        if html != 'html/pages.html' and html != 'html/doxygen_crawl.html':
-            patch_html(html, repo, pagemap[html], branch, license_link)
-
+    htmls = [html for html in glob.glob("html/*.html")
+             if html != 'html/pages.html' and html != 'html/doxygen_crawl.html']
+    # Each file is patched independently, so overlap their I/O
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+        list(ex.map(lambda html: patch_html(html, repo, pagemap[html],
+                                            branch, license_link), htmls))
 
 
 def main():
@@ -744,11 +1028,12 @@ def main():
     imp_version = IMP_STABLE_RELEASE if branch == 'main' else 'nightly'
 
     tags = get_tag_files(imp_version)
+    rl = RefLinks()
+    rl.load_or_parse([(t.xml_filename, t.doctop) for t in tags])
 
     cow = CellOutputWriter('html')
-    g = FileGenerator(tags)
-    for f in args.filename:
-        g.generate_files(f, output_writer=cow)
+    g = FileGenerator(rl)
+    g.generate_all_files(args.filename, output_writer=cow)
     make_doxyfile(args.filename, tags)
     run_doxygen()
     fix_md_html_files()
@@ -7,10 +7,22 @@ import utils
 import subprocess
 import contextlib
 import shutil
+import tempfile
+import atexit
 
 TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
+# make-docs.py imports tutorial_common.py from its own directory
+sys.path.insert(0, os.path.join(TOPDIR, 'doxygen'))
+import tutorial_common
+
+_make_docs_module = None
+
 def import_make_docs():
+    """Import make-docs.py as a module (only the first time it is needed)"""
+    global _make_docs_module
+    if _make_docs_module is not None:
+        return _make_docs_module
     import importlib.util
     make_docs = os.path.join(TOPDIR, "doxygen", "make-docs.py")
     name = os.path.splitext(make_docs)[0]
@@ -18,45 +30,93 @@ def import_make_docs():
     module = importlib.util.module_from_spec(spec)
     sys.modules[name] = module
     spec.loader.exec_module(module)
+    _make_docs_module = module
     return module
 
-# Python script to simulate running doxygen
-DOXYGEN = """
-from __future__ import print_function
-import os
-import sys
+@contextlib.contextmanager
+def _chdir(dirname):
+    olddir = os.getcwd()
+    os.chdir(dirname)
+    try:
+        yield
+    finally:
+        os.chdir(olddir)
 
-def make_file(subdir, fname, contents):
-    with open(os.path.join(subdir, fname), 'w') as fh:
-        fh.write(contents)
+def _run_make_docs(args, cwd):
+    """Run make-docs.py in this process (much quicker than starting
+       a new Python interpreter)"""
+    make_docs = import_make_docs()
+    # Cached values depend on the current directory, so start afresh
+    for obj in vars(make_docs).values():
+        if hasattr(obj, 'cache_clear'):
+            obj.cache_clear()
+    # TOPDIR is normally set relative to the directory make-docs.py is run in
+    oldargv, oldtopdir = sys.argv, make_docs.TOPDIR
+    sys.argv = ['make-docs.py'] + args
+    make_docs.TOPDIR = os.path.dirname(os.path.abspath(cwd))
+    try:
+        with _chdir(cwd):
+            make_docs.main()
+    finally:
+        sys.argv, make_docs.TOPDIR = oldargv, oldtopdir
 
-if len(sys.argv) >= 2 and sys.argv[1] == '-s':
-    for name in ('FILE_VERSION_FILTER', 'LAYOUT_FILE', 'PROJECT_NAME',
-                 'INPUT', 'SEARCHENGINE', 'TOC_INCLUDE_HEADINGS',
-                 'IMAGE_PATH', 'HTML_HEADER', 'HTML_FOOTER', 'GENERATE_LATEX',
-                 'TAGFILES', 'EXAMPLE_PATH'):
-        print("%-23s=" % name)
-else:
-    os.mkdir('html')
-    make_file('html', 'index.html', "$(function() {\\n  initMenu('',false,false,'search.php','Search');\\n});\\n<hr class=\\"footer\\"/>\\n")
-    make_file('html', 'pages.html', 'foo')
-    make_file('html', 'menudata.js', 'foo')
+# Shell script to simulate running doxygen (much quicker to start than
+# a Python script)
+DOXYGEN = """#!/bin/sh
+set -e
+if [ "$1" = "-s" ]; then
+  printf '%-23s=\\n' FILE_VERSION_FILTER LAYOUT_FILE PROJECT_NAME \\
+         INPUT SEARCHENGINE TOC_INCLUDE_HEADINGS IMAGE_PATH HTML_HEADER \\
+         HTML_FOOTER GENERATE_LATEX TAGFILES EXAMPLE_PATH
+else
+  mkdir html
+  cat > html/index.html <<'END'
+$(function() {
+  initMenu('',false,false,'search.php','Search');
+});
+<hr class="footer"/>
+END
+  # A page that was not generated from any of our markdown files
+  cp html/index.html html/files.html
+  printf foo > html/pages.html
+  printf foo > html/menudata.js
+fi
 """
 
+# Directories containing mock doxygen binaries, keyed by exit status
+_MOCK_DOXYGEN_DIRS = {}
+
+def _get_mock_doxygen_dir(retval):
+    """Get a directory containing a mock 'doxygen' binary, making it only
+       the first time it is needed"""
+    bindir = _MOCK_DOXYGEN_DIRS.get(retval)
+    if bindir is None:
+        bindir = tempfile.mkdtemp(prefix='bin-')
+        atexit.register(shutil.rmtree, bindir, True)
+        dox = os.path.join(bindir, 'doxygen')
+        with open(dox, 'w') as fh:
+            fh.write("%sexit %d\n" % (DOXYGEN, retval))
+        os.chmod(dox, 493) # 493 = octal 0755, i.e. executable
+        _MOCK_DOXYGEN_DIRS[retval] = bindir
+    return bindir
+
 @contextlib.contextmanager
 def mock_doxygen(topdir, retval=0):
-    """Make a mock 'doxygen' binary and add it to the PATH"""
-    bindir = os.path.join(topdir, 'bin')
-    os.mkdir(bindir)
-    dox = os.path.join(bindir, 'doxygen')
-    with open(dox, 'w') as fh:
-        fh.write("#!%s\n%ssys.exit(%d)" % (sys.executable, DOXYGEN, retval))
-    os.chmod(dox, 493) # 493 = octal 0755, i.e. executable
+    """Add a mock 'doxygen' binary to the PATH"""
+    bindir = _get_mock_doxygen_dir(retval)
     oldpath = os.environ['PATH']
+    oldcache = os.environ.get('XDG_CACHE_HOME')
     os.environ['PATH'] = bindir + ':' + oldpath
-    yield None
-    os.environ['PATH'] = oldpath
-    shutil.rmtree(bindir)
+    # Don't cache the doxygen template in the user's home directory
+    os.environ['XDG_CACHE_HOME'] = os.path.join(topdir, 'cache')
+    try:
+        yield None
+    finally:
+        os.environ['PATH'] = oldpath
+        if oldcache is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = oldcache
 
 def make_file(subdir, fname, contents):
     with open(os.path.join(subdir, fname), 'w') as fh:
@@ -75,15 +135,23 @@ def _make_docs(tmpdir):
 class Tests(unittest.TestCase):
     def test_complete(self):
         """Test simple complete run of make-docs.py"""
-        make_docs = os.path.join(TOPDIR, "doxygen", "make-docs.py")
         with utils.temporary_directory(TOPDIR) as tmpdir:
             docdir = _make_docs(tmpdir)
             make_file(tmpdir, "LICENSE", "Some random license")
             with mock_doxygen(tmpdir):
-                subprocess.check_call([make_docs], cwd=docdir)
+                _run_make_docs([], cwd=docdir)
             with open(os.path.join(docdir, 'html', 'index.html')) as fh:
                 contents = fh.read()
             self.assertFalse("creativecommons.org" in contents)
+            self.assertTrue("Edit on GitHub" in contents)
+            # Pages not generated from markdown should be left alone
+            with open(os.path.join(docdir, 'html', 'files.html')) as fh:
+                contents = fh.read()
+            self.assertFalse("Edit on GitHub" in contents)
+            with open(os.path.join(docdir, 'Doxyfile')) as fh:
+                contents = fh.read()
+            self.assertTrue('PROJECT_NAME = "Intro"\n' in contents)
+            self.assertTrue('INPUT = .\n' in contents)
             # Check for generated outputs
             os.unlink(os.path.join(docdir, 'manual-tags.xml'))
             os.unlink(os.path.join(docdir, 'ref-tags.xml'))
@@ -92,14 +160,12 @@ class Tests(unittest.TestCase):
 
     def test_custom_branch(self):
         """Test make-docs.py with manually-specified branch"""
-        make_docs = os.path.join(TOPDIR, "doxygen", "make-docs.py")
         with utils.temporary_directory(TOPDIR) as tmpdir:
             docdir = _make_docs(tmpdir)
             make_file(tmpdir, "LICENSE",
                       "Attribution-ShareAlike 4.0 International")
             with mock_doxygen(tmpdir):
-                subprocess.check_call([make_docs, '--branch', 'main'],
-                                      cwd=docdir)
+                _run_make_docs(['--branch', 'main'], cwd=docdir)
             with open(os.path.join(docdir, 'html', 'index.html')) as fh:
                 contents = fh.read()
             self.assertTrue("creativecommons.org" in contents)
@@ -116,14 +182,112 @@ class Tests(unittest.TestCase):
         with utils.temporary_directory(TOPDIR) as tmpdir:
             docdir = _make_docs(tmpdir)
             with mock_doxygen(tmpdir, retval=1):
-                p = subprocess.Popen([make_docs], cwd=docdir,
-                                     universal_newlines=True,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-                stdout, stderr = p.communicate()
+                p = subprocess.run([make_docs], cwd=docdir,
+                                   capture_output=True, text=True, timeout=30)
                 self.assertEqual(p.returncode, 1)
-                self.assertTrue('OSError: doxygen failed' in stderr,
-                                msg="bad stderr %s" % stderr)
+                self.assertTrue('OSError: doxygen failed' in p.stderr,
+                                msg="bad stderr %s" % p.stderr)
+
+    def test_doxygen_template_cache(self):
+        """Test caching of the doxygen configuration template"""
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            with mock_doxygen(tmpdir):
+                lines = tutorial_common.get_doxygen_template()
+                self.assertTrue(lines[0].startswith('FILE_VERSION_FILTER '))
+                cache = tutorial_common._get_doxygen_template_cache()
+                self.assertTrue(os.path.exists(cache))
+                # Subsequent calls should use the cache, not run doxygen
+                make_file(os.path.dirname(cache), os.path.basename(cache),
+                          "PROJECT_NAME =\n")
+                lines = tutorial_common.get_doxygen_template()
+                self.assertEqual(lines, ["PROJECT_NAME =\n"])
+                # A different doxygen binary should not use the same cache
+                dox = shutil.which('doxygen')
+                st = os.stat(dox)
+                os.utime(dox, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+                try:
+                    self.assertNotEqual(
+                        tutorial_common._get_doxygen_template_cache(), cache)
+                finally:
+                    os.utime(dox, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def test_patch_html(self):
+        """Test patch_html"""
+        make_docs = import_make_docs()
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            fname = os.path.join(tmpdir, "good.html")
+            make_file(tmpdir, "good.html",
+                      "foo\n  initMenu('',false,false,'x');\n"
+                      "<hr class=\"footer\"/>\nbar\n")
+            make_docs.patch_html(fname, 'repo', 'foo.md', 'main', 'LICENSE\n')
+            with open(fname) as fh:
+                lines = fh.readlines()
+            self.assertEqual(len(lines), 6)
+            self.assertEqual(lines[1], "  initMenu('',false,false,'x');\n")
+            self.assertTrue('salilab/repo/blob/main/doc/foo.md' in lines[2])
+            self.assertEqual(lines[3], '<hr class="footer"/>\n')
+            self.assertEqual(lines[4], 'LICENSE\n')
+            # Patching again should be a no-op
+            make_docs.patch_html(fname, 'repo', 'foo.md', 'main', 'LICENSE\n')
+            with open(fname) as fh:
+                self.assertEqual(fh.readlines(), lines)
+            make_file(tmpdir, "bad.html", "foo\n")
+            self.assertRaises(ValueError, make_docs.patch_html,
+                              os.path.join(tmpdir, "bad.html"), 'repo',
+                              'foo.md', 'main', '')
+
+    def test_read_git_remote_url(self):
+        """Test read_git_remote_url"""
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            make_file(tmpdir, "config",
+                      '[core]\n\tbare = false\n'
+                      '[remote "origin"]\n'
+                      '\turl = https://github.com/salilab/foo.git\n'
+                      '\tfetch = +refs/heads/*:refs/remotes/origin/*\n')
+            self.assertEqual(tutorial_common.read_git_remote_url(tmpdir),
+                             'https://github.com/salilab/foo.git')
+            make_file(tmpdir, "config", '[core]\n\tbare = false\n')
+            self.assertIsNone(tutorial_common.read_git_remote_url(tmpdir))
+
+    def test_git_info(self):
+        """Test get_git_branch and get_git_repo"""
+        def check(subdir, branch):
+            with _chdir(subdir):
+                for func in (tutorial_common.get_git_dirs,
+                             tutorial_common.get_git_branch,
+                             tutorial_common.get_git_repo):
+                    func.cache_clear()
+                self.assertEqual(tutorial_common.get_git_branch(), branch)
+                self.assertEqual(tutorial_common.get_git_repo(), 'foo')
+                # The config should have been read directly from .git
+                gitdir, commondir = tutorial_common.get_git_dirs()
+                self.assertTrue(os.path.isabs(commondir))
+                self.assertEqual(
+                    tutorial_common.read_git_remote_url(commondir),
+                    'https://github.com/salilab/foo.git')
+
+        def git(*args):
+            subprocess.check_call(
+                ['git', '-c', 'user.name=test', '-c', 'user.email=test@test',
+                 '-c', 'init.defaultBranch=main'] + list(args),
+                cwd=repo, stdout=subprocess.DEVNULL)
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            repo = os.path.join(tmpdir, 'repo')
+            os.mkdir(repo)
+            git('init', '-q')
+            git('remote', 'add', 'origin',
+                'https://github.com/salilab/foo.git')
+            git('checkout', '-q', '-b', 'main')
+            git('commit', '-q', '--allow-empty', '-m', 'initial')
+            subdir = os.path.join(repo, 'doc')
+            os.mkdir(subdir)
+            check(repo, 'main')
+            # Should also work from a subdirectory of the repository
+            check(subdir, 'main')
+            # ... and from a worktree (where .git is a file)
+            worktree = os.path.join(tmpdir, 'worktree')
+            git('worktree', 'add', '-q', '-b', 'wt', worktree)
+            check(worktree, 'wt')
 
     def test_read_yaml_file(self):
         """Test read_yaml_file"""
@@ -132,6 +296,12 @@ class Tests(unittest.TestCase):
             make_file(tmpdir, "m.yaml", "bar: baz\ntitle: Intro\nfoo: bar\n")
             t = make_docs.read_yaml_file(os.path.join(tmpdir, 'm.yaml'))
             self.assertEqual(t, "Intro")
+            make_file(tmpdir, "first.yaml", "title: First")
+            t = make_docs.read_yaml_file(os.path.join(tmpdir, 'first.yaml'))
+            self.assertEqual(t, "First")
+            make_file(tmpdir, "bad.yaml", "subtitle: Intro\n")
+            self.assertRaises(ValueError, make_docs.read_yaml_file,
+                              os.path.join(tmpdir, 'bad.yaml'))
 
     def test_get_pagename(self):
         """Test get_pagename"""
@@ -144,6 +314,10 @@ class Tests(unittest.TestCase):
             self.assertEqual(n, "anchor")
             self.assertRaises(ValueError, make_docs.get_pagename,
                               os.path.join(tmpdir, "bad.md"), r)
+            # Page name should be found even if not near the top of the file
+            make_file(tmpdir, "long.md", "foo\n" * 20000 + "# t {#late}\n")
+            n = make_docs.get_pagename(os.path.join(tmpdir, "long.md"))
+            self.assertEqual(n, "late")
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,506 @@
+import unittest
+import os
+import re
+import sys
+import io
+import json
+import base64
+import contextlib
+import email.message
+import urllib.error
+import urllib.request
+import utils
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def import_process_notebook():
+    # process_notebook.py imports inventory.py from its own directory
+    sys.path.insert(0, os.path.join(TOPDIR, 'notebook'))
+    try:
+        import process_notebook
+    finally:
+        del sys.path[0]
+    return process_notebook
+
+class MockResponse(object):
+    """Simulate a response from urllib.request.urlopen"""
+    def __init__(self, data, headers):
+        self._data = data
+        self.headers = email.message.Message()
+        for k, v in headers.items():
+            self.headers[k] = v
+
+    def read(self):
+        return self._data
+
+@contextlib.contextmanager
+def mock_urlopen(handler):
+    """Replace urllib.request.urlopen with `handler`, which is given each
+       Request and returns a MockResponse or raises an exception"""
+    orig = urllib.request.urlopen
+    urllib.request.urlopen = handler
+    try:
+        yield
+    finally:
+        urllib.request.urlopen = orig
+
+@contextlib.contextmanager
+def chdir(dirname):
+    olddir = os.getcwd()
+    os.chdir(dirname)
+    try:
+        yield
+    finally:
+        os.chdir(olddir)
+
+def make_file(subdir, fname, contents):
+    with open(os.path.join(subdir, fname), 'w') as fh:
+        fh.write(contents)
+
+TAG_FILE = """<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>
+<tagfile>
+  <compound kind="class">
+    <name>IMP::Model</name>
+    <filename>classIMP_1_1Model.html</filename>
+  </compound>
+  <compound kind="page">
+    <name>mypage</name>
+    <title>My page</title>
+    <filename>mypage</filename>
+    <docanchor file="mypage" title="My page">mypage</docanchor>
+    <docanchor file="mypage" title="Section">mysection</docanchor>
+  </compound>
+</tagfile>
+"""
+
+def make_template(subdir, root, title):
+    """Make a simple Jupyter notebook template"""
+    j = {'cells': [
+            {'cell_type': 'markdown', 'metadata': {},
+             'source': ['%s {#%s}\n' % (title, root), '=====\n', '\n',
+                        'Uses ``IMP.Model``.\n', '\n',
+                        '# Section\n', 'Some text.\n']},
+            {'cell_type': 'code', 'execution_count': None, 'metadata': {},
+             'outputs': [], 'source': ['x = 1\n', 'print(x)']},
+            {'cell_type': 'markdown', 'metadata': {},
+             'source': ['%%nbexclude\n', 'Not in the notebook.\n']}],
+         'metadata': {'kernelspec': {'display_name': 'Python 3',
+                                     'language': 'python',
+                                     'name': 'python3'}},
+         'nbformat': 4, 'nbformat_minor': 2}
+    with open(os.path.join(subdir, '.template.%s.ipynb' % root), 'w') as fh:
+        json.dump(j, fh, indent=2)
+
+MODEL_URL = 'https://example.com/ref/classIMP_1_1Model.html'
+
+class Tests(unittest.TestCase):
+    def test_cached_url_cwd(self):
+        """Test get_cached_url from different directories"""
+        pn = import_process_notebook()
+        handler = lambda req: MockResponse(b'data', {})
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            for subdir in ('a', 'b'):
+                os.mkdir(os.path.join(tmpdir, subdir))
+                # The cache directory should be made in each directory
+                with chdir(os.path.join(tmpdir, subdir)), \
+                        mock_urlopen(handler):
+                    fname = pn.get_cached_url('https://x/foo', 'foo')
+                    with open(fname, 'rb') as fh:
+                        self.assertEqual(fh.read(), b'data')
+
+    def test_cached_url_conditional(self):
+        """Test get_cached_url only downloads a changed file"""
+        pn = import_process_notebook()
+        requests = []
+        def ok(req):
+            requests.append(req)
+            return MockResponse(b'data', {'ETag': '"abc"',
+                                          'Last-Modified': 'Mon, 1 Jan 2024'})
+        def not_modified(req):
+            requests.append(req)
+            raise urllib.error.HTTPError(req.full_url, 304, 'Not Modified',
+                                         {}, None)
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            with chdir(tmpdir):
+                with mock_urlopen(ok):
+                    fname = pn.get_cached_url('https://x/foo', 'foo')
+                    # A recent file should be used without asking the server
+                    pn.get_cached_url('https://x/foo', 'foo')
+                self.assertEqual(len(requests), 1)
+                self.assertIsNone(requests[0].get_header('If-none-match'))
+                with open(fname + '.headers') as fh:
+                    self.assertEqual(json.load(fh),
+                                     {'ETag': '"abc"',
+                                      'Last-Modified': 'Mon, 1 Jan 2024'})
+                # Make the last check more than a day old
+                old = os.stat(fname).st_mtime - 2 * 86400
+                os.utime(fname, (old, old))
+                os.utime(fname + '.headers', (old, old))
+                with mock_urlopen(not_modified):
+                    self.assertEqual(pn.get_cached_url('https://x/foo', 'foo'),
+                                     fname)
+                self.assertEqual(len(requests), 2)
+                self.assertEqual(requests[1].get_header('If-none-match'),
+                                 '"abc"')
+                self.assertEqual(requests[1].get_header('If-modified-since'),
+                                 'Mon, 1 Jan 2024')
+                # File should be untouched, but marked as recently checked
+                with open(fname, 'rb') as fh:
+                    self.assertEqual(fh.read(), b'data')
+                self.assertAlmostEqual(os.stat(fname).st_mtime, old, delta=1)
+                self.assertLess(pn.file_age(fname + '.headers'), 86400)
+
+    def test_fix_links(self):
+        """Test RefLinks.fix_links"""
+        pn = import_process_notebook()
+        rl = pn.RefLinks()
+        rl.refs['IMP::Model'] = MODEL_URL
+        rl.refs['mypage'] = 'https://example.com/ref/mypage.html'
+        rl._add_dotted_aliases()
+        self.assertEqual(rl.fix_links('See [the page](@ref mypage).'),
+                         'See [the page](https://example.com/ref/mypage.html).')
+        self.assertEqual(rl.fix_links('[Model](@ref IMP::Model)'),
+                         '[Model](%s)' % MODEL_URL)
+        # Backtick shorthand, with or without the full name
+        self.assertEqual(rl.fix_links('Use ``IMP.Model`` or ``~IMP.Model``'),
+                         'Use [IMP.Model](%s) or [Model](%s)'
+                         % (MODEL_URL, MODEL_URL))
+        self.assertRaises(ValueError, rl.fix_links, '@ref IMP::Foo')
+        olddir = os.getcwd()
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                # Links in included files are handled, but not includes
+                make_file(tmpdir, 'inc.py',
+                          'x = 1 # ``IMP.Model``\n%%include other.py\n')
+                self.assertEqual(
+                    rl.fix_links('%%include inc.py\n@ref mypage'),
+                    'x = 1 # [IMP.Model](%s)\n%%%%include other.py\n\n'
+                    'https://example.com/ref/mypage.html' % MODEL_URL)
+            finally:
+                os.chdir(olddir)
+
+    def test_refs_cache(self):
+        """Test caching of parsed doxygen tag files"""
+        pn = import_process_notebook()
+        parsed = []
+
+        def load(tag_files):
+            rl = pn.RefLinks()
+            orig_parse = rl.parse_doxygen_tag_file
+            def parse(filename, urltop):
+                parsed.append(filename)
+                orig_parse(filename, urltop)
+            rl.parse_doxygen_tag_file = parse
+            rl.load_or_parse(tag_files)
+            return rl
+
+        olddir = os.getcwd()
+        orig_source_hash = pn._get_source_hash
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                make_file(tmpdir, 'ref-tags.xml', TAG_FILE)
+                tags = [('ref-tags.xml', 'https://example.com/ref/')]
+                rl = load(tags)
+                self.assertEqual(parsed, ['ref-tags.xml'])
+                self.assertEqual(rl.refs['IMP::Model'],
+                                 'https://example.com/ref/'
+                                 'classIMP_1_1Model.html')
+                # Second load should use the cache
+                rl = load(tags)
+                self.assertEqual(parsed, ['ref-tags.xml'])
+                self.assertEqual(rl._dotted_refs['IMP.Model'],
+                                 'https://example.com/ref/'
+                                 'classIMP_1_1Model.html')
+                # A different URL should invalidate the cache
+                tags = [('ref-tags.xml', 'https://example.com/other/')]
+                rl = load(tags)
+                self.assertEqual(len(parsed), 2)
+                self.assertEqual(rl.refs['IMP::Model'],
+                                 'https://example.com/other/'
+                                 'classIMP_1_1Model.html')
+                # So should a change to the tag file
+                st = os.stat('ref-tags.xml')
+                os.utime('ref-tags.xml', (st.st_atime, st.st_mtime + 10))
+                load(tags)
+                self.assertEqual(len(parsed), 3)
+                load(tags)
+                self.assertEqual(len(parsed), 3)
+                # So should a change to process_notebook.py itself
+                pn._get_source_hash = lambda: 'changed'
+                load(tags)
+                self.assertEqual(len(parsed), 4)
+                # Only the most recent cache should be kept
+                self.assertEqual(len(os.listdir('.cache')), 1)
+            finally:
+                pn._get_source_hash = orig_source_hash
+                os.chdir(olddir)
+
+    def test_page_tags(self):
+        """Test reading page anchors from doxygen tag files"""
+        pn = import_process_notebook()
+        rl = pn.RefLinks()
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            make_file(tmpdir, 'ref-tags.xml', TAG_FILE)
+            rl.parse_doxygen_tag_file(os.path.join(tmpdir, 'ref-tags.xml'),
+                                      'https://x/ref/')
+        # An anchor with the same name as its page wins over the page
+        self.assertEqual(rl.refs['mypage'], 'https://x/ref/mypage.html#mypage')
+        self.assertEqual(rl.refs['mysection'],
+                         'https://x/ref/mypage.html#mysection')
+        self.assertEqual(rl.fix_links('@ref mypage'),
+                         'https://x/ref/mypage.html#mypage')
+
+    def test_generate_all_files(self):
+        """Test generating files from several templates in parallel"""
+        pn = import_process_notebook()
+        rl = pn.RefLinks()
+        rl.refs['IMP::Model'] = MODEL_URL
+        rl._add_dotted_aliases()
+        roots = ['foo', 'bar']
+        outputs = ['%s.%s' % (root, ext) for root in roots
+                   for ext in ('md', 'py', 'ipynb')]
+
+        def generate(parallel):
+            fg = pn.FileGenerator(rl)
+            writer = pn.CellOutputWriter(tmpdir)
+            if parallel:
+                fg.generate_all_files(roots, writer)
+            else:
+                for root in roots:
+                    fg.generate_files(root, writer)
+            contents = {}
+            for fname in outputs:
+                with open(fname) as fh:
+                    contents[fname] = fh.read()
+                os.unlink(fname)
+            return contents
+
+        pools = []
+        class RecordingPool(pn.ProcessPoolExecutor):
+            def __init__(self, *args, **kwargs):
+                pools.append(self)
+                super().__init__(*args, **kwargs)
+
+        olddir = os.getcwd()
+        orig_pool = pn.ProcessPoolExecutor
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            os.chdir(tmpdir)
+            pn.ProcessPoolExecutor = RecordingPool
+            try:
+                make_template(tmpdir, 'foo', 'Foo')
+                make_template(tmpdir, 'bar', 'Bar')
+                serial = generate(parallel=False)
+                self.assertEqual(pools, [])
+                parallel = generate(parallel=True)
+                self.assertEqual(len(pools), 1)
+                # Output should not depend on how the files were generated
+                self.assertEqual(parallel, serial)
+                self.assertIn(MODEL_URL, serial['foo.md'])
+                self.assertNotIn('Not in the notebook', serial['bar.ipynb'])
+                # A single template should not need a process pool
+                fg = pn.FileGenerator(rl)
+                fg.generate_all_files(['foo'], pn.CellOutputWriter(tmpdir))
+                self.assertEqual(len(pools), 1)
+                with open('foo.md') as fh:
+                    self.assertEqual(fh.read(), serial['foo.md'])
+            finally:
+                pn.ProcessPoolExecutor = orig_pool
+                os.chdir(olddir)
+
+    def test_get_pagename(self):
+        """Test finding and caching page names in Markdown files"""
+        pn = import_process_notebook()
+        regex = re.compile(rb'{#(\S+)}')
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            fname = os.path.join(tmpdir, 'foo.md')
+            make_file(tmpdir, 'foo.md', 'Title {#foo}\n\nSee {#other}\n')
+            self.assertEqual(pn.get_pagename(fname, regex), 'foo')
+            # An unchanged file should not be read again
+            hits = pn._get_pagename.cache_info().hits
+            self.assertEqual(pn.get_pagename(fname, regex), 'foo')
+            self.assertEqual(pn._get_pagename.cache_info().hits, hits + 1)
+            # A modified file should be reread
+            st = os.stat(fname)
+            make_file(tmpdir, 'foo.md', 'Title {#bar}\n')
+            os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertEqual(pn.get_pagename(fname, regex), 'bar')
+            # Files without a page name, including empty files, are errors
+            for contents in ('No name\n', ''):
+                make_file(tmpdir, 'bad.md', contents)
+                self.assertRaises(ValueError, pn.get_pagename,
+                                  os.path.join(tmpdir, 'bad.md'), regex)
+
+    def test_add_html_links(self):
+        """Test adding links to doxygen HTML output"""
+        pn = import_process_notebook()
+        page = ("<head>\n  initMenu('',false,false,'search.php','Search');\n"
+                "</head>\n<hr class=\"footer\"/>\n")
+        orig_topdir, orig_repo = pn.get_topdir, pn.get_git_repo
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            subdir = os.path.join(tmpdir, 'tut')
+            os.makedirs(os.path.join(subdir, 'html'))
+            make_file(tmpdir, 'LICENSE',
+                      'Attribution-ShareAlike 4.0 International')
+            make_file(subdir, 'README.md', 'Not a page')
+            for root in ('foo', 'bar', 'mainpage'):
+                make_file(subdir, '%s_src.md' % root,
+                          'Title {#%s}\n=====\n' % root)
+            for html in ('foo', 'bar', 'index', 'pages'):
+                make_file(os.path.join(subdir, 'html'), html + '.html', page)
+            pn.get_topdir = lambda: tmpdir
+            pn.get_git_repo = lambda: 'myrepo'
+            try:
+                with chdir(subdir):
+                    pn.add_html_links('main')
+                    for root in ('foo', 'bar', 'mainpage'):
+                        html = 'index' if root == 'mainpage' else root
+                        with open('html/%s.html' % html) as fh:
+                            contents = fh.read()
+                        self.assertIn(
+                            'https://github.com/salilab/myrepo/blob/main/tut/'
+                            '.template.%s_src.ipynb' % root, contents)
+                        self.assertIn('doxlicense', contents)
+                    # The list of pages should not be touched
+                    with open('html/pages.html') as fh:
+                        self.assertEqual(fh.read(), page)
+                    # Errors in any thread should be reported
+                    make_file('html', 'bar.html', 'garbage')
+                    self.assertRaises(ValueError, pn.add_html_links, 'main')
+            finally:
+                pn.get_topdir, pn.get_git_repo = orig_topdir, orig_repo
+
+    def test_get_cell_subsets(self):
+        """Test splitting cells into HTML, notebook and Colab subsets"""
+        pn = import_process_notebook()
+        # First line of each cell, and the subsets it should be in
+        cells = [('x = 1\n', 'html nb colab'),
+                 ('%%htmlexclude\n', 'nb colab'),
+                 ('%%nbexclude\n', 'html colab'),
+                 ('%%colabexclude\n', 'html nb'),
+                 ('#%%colabexclude\n', 'html nb'),
+                 ('%%htmlonly\n', 'html'),
+                 ('%%nbonly\n', 'nb'),
+                 ('#%%colabonly\n', 'colab'),
+                 ('print("100%% sure")\n', 'html nb colab'),
+                 (None, 'html nb colab')]
+        # Magics are only recognized in the first line
+        cells = [({'source': [first, 'y = 2\n', '%%nbexclude\n']
+                   if first else []}, subsets.split())
+                 for first, subsets in cells]
+        html, nb, colab = pn.get_cell_subsets([c[0] for c in cells])
+        for name, subset in (('html', html), ('nb', nb), ('colab', colab)):
+            self.assertEqual(subset,
+                             [c[0] for c in cells if name in c[1]])
+
+    def test_cell_output_writer(self):
+        """Test writing plot images from cell outputs"""
+        pn = import_process_notebook()
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            cow = pn.CellOutputWriter(tmpdir)
+            b64 = base64.b64encode(b'fakepng1').decode('ascii')
+            cells = [{'outputs': [{'output_type': 'display_data',
+                                   'data': {'image/png': b64}}]},
+                     # Raw data, if present, should be used as-is
+                     {'outputs': [{'output_type': 'display_data',
+                                   'data': {'image/png': 'not base64!'},
+                                   pn.RAW_PNG_KEY: b'fakepng2'}]}]
+            fh = io.StringIO()
+            for cell in cells:
+                cow.write(cell, fh)
+            self.assertIn('<img src="matplotlib/2.png" />', fh.getvalue())
+            for i in (1, 2):
+                fname = os.path.join(tmpdir, 'matplotlib', '%d.png' % i)
+                with open(fname, 'rb') as fh:
+                    self.assertEqual(fh.read(), b'fakepng%d' % i)
+            # The raw data should have been removed from the output
+            self.assertNotIn(pn.RAW_PNG_KEY, cells[1]['outputs'][0])
+
+    @unittest.skipIf(matplotlib is None, "matplotlib not available")
+    def test_plot_outputs(self):
+        """Test that generated plots match in HTML and notebook outputs"""
+        pn = import_process_notebook()
+        j = {'cells': [
+                {'cell_type': 'markdown', 'metadata': {},
+                 'source': ['Plot {#foo}\n', '%gencelloutputs\n']},
+                {'cell_type': 'code', 'execution_count': None,
+                 'metadata': {}, 'outputs': [],
+                 'source': ['import matplotlib.pyplot as plt\n',
+                            'plt.plot([1, 2])']},
+                # Output of this cell is never given to CellOutputWriter
+                {'cell_type': 'code', 'execution_count': None,
+                 'metadata': {}, 'outputs': [],
+                 'source': ['%%htmlexclude\n', 'plt.plot([2, 1])']}],
+             'metadata': {'kernelspec': {'display_name': 'Python 3',
+                                         'language': 'python',
+                                         'name': 'python3'}},
+             'nbformat': 4, 'nbformat_minor': 2}
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            with open(os.path.join(tmpdir, '.template.foo.ipynb'), 'w') as fh:
+                json.dump(j, fh)
+            with chdir(tmpdir):
+                fg = pn.FileGenerator(pn.RefLinks())
+                fg.generate_files('foo', pn.CellOutputWriter(tmpdir))
+                with open('foo.ipynb') as fh:
+                    cells = json.load(fh)['cells']
+                for cell in cells[1:]:
+                    self.assertNotIn(pn.RAW_PNG_KEY, cell['outputs'][0])
+                out = cells[1]['outputs'][0]
+                with open(os.path.join('matplotlib', '1.png'), 'rb') as fh:
+                    self.assertEqual(fh.read(),
+                                     base64.b64decode(out['data']['image/png']))
+
+    def test_read_notebook(self):
+        """Test reading notebooks, with and without orjson"""
+        pn = import_process_notebook()
+        contents = ('{"cells": [{"cell_type": "code", "execution_count": null,'
+                    ' "source": ["caf\\u00e9 \\u2014 x = 1.0e3\\n"],'
+                    ' "metadata": {}}],'
+                    ' "nbformat": 4}')
+        orig_orjson = pn.orjson
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            fname = os.path.join(tmpdir, 'in.ipynb')
+            with open(fname, 'w') as fh:
+                fh.write(contents)
+            expected = json.loads(contents)
+            try:
+                # orjson is only used if it is installed
+                for orjson in (orig_orjson, None):
+                    pn.orjson = orjson
+                    self.assertEqual(pn.read_notebook(fname), expected)
+            finally:
+                pn.orjson = orig_orjson
+
+    def test_write_notebook(self):
+        """Test that notebooks are written as by json.dump"""
+        pn = import_process_notebook()
+        j = {'cells': [{'cell_type': 'markdown', 'metadata': {},
+                        'source': ['caf\u00e9 \u2014 \u00c5\n', 'x = 1.0']}],
+             'nbformat': 4, 'nbformat_minor': 2}
+        orig_orjson = pn.orjson
+        with utils.temporary_directory(TOPDIR) as tmpdir:
+            expected = os.path.join(tmpdir, 'expected.ipynb')
+            with open(expected, 'w') as fh:
+                json.dump(j, fh, indent=2)
+            with open(expected, 'rb') as fh:
+                expected = fh.read()
+            # Output should be the same whether or not orjson is available
+            try:
+                for orjson in (orig_orjson, None):
+                    pn.orjson = orjson
+                    fname = os.path.join(tmpdir, 'out.ipynb')
+                    pn.write_notebook(fname, j)
+                    with open(fname, 'rb') as fh:
+                        self.assertEqual(fh.read(), expected)
+                    self.assertEqual(pn.read_notebook(fname), j)
+            finally:
+                pn.orjson = orig_orjson
+
+if __name__ == '__main__':
+    unittest.main()
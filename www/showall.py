@@ -1,98 +1,32 @@
 #!/usr/bin/python3
 
-import cgitb
-import traceback
 import os
 import sys
-import glob
+import io
+import contextlib
 import json
+import heapq
+import collections
 import yaml
+try:
+    # orjson and libyaml are much faster than the pure Python parsers
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader
 
 IMP_STABLE_RELEASE = '2.22.0'
 
-
-def _filter_repo_name(name):
-    # Special case the original imp_tutorial repository
-    if name == 'imp_tutorial':
-        return 'rnapolii_stalk'
-    if name.startswith('imp_'):
-        name = name[4:]
-    if name.endswith('_tutorial'):
-        name = name[:-9]
-    return name
+# The page header (including the CGI headers) never changes, so only
+# build it once
+_HEADER_HTML = """Content-type: text/html
+X-Robots-Tag: noindex, nofollow
 
 
-class Tutorial:
-    def __init__(self, name, metadata):
-        self.name, self.metadata = name, metadata
-        self._deps = frozenset(_filter_repo_name(x)
-                               for x in metadata.get('depends', []))
 
-    def __lt__(self, other):
-        # Simple ordering of tutorials:
-        # if one tutorial is explicitly listed as depending on another, it
-        # is ordered after the other; otherwise, tutorials without dependencies
-        # are listed first
-        if other.name in self._deps:
-            return False
-        elif self.name in other._deps:
-            return True
-        else:
-            return len(self._deps) < len(other._deps)
-
-
-class Page:
-    def display(self):
-        self.print_header()
-        self.show_tutorials()
-        self.print_footer()
-
-    def show_tutorials(self):
-        print('<div style="padding-bottom: 1.7em"></div>')
-        print('<div class="header">')
-        print('<div class="headertitle">')
-        print('<div class="title">IMP Tutorial Index</div>')
-        print('</div></div>')
-        print('<div class="contents">')
-        print('<div class="textblock">')
-        self.print_tutorial_list("*/build.json", prefix='')
-        self.print_tutorial_list("*/*/build.json",
-                       prefix="""
-<h2>Tutorials for IMP nightly build</h2>
-<p>These tutorials demonstrate new features of IMP that are not in the
-most recent stable release. They will only work with a recent
-<a href="/download.html#develop">nightly build</a> of IMP, or IMP
-<a href="/nightly/doc/manual/installation.html#installation_source">compiled
-from source code</a> from the git <tt>develop</tt> branch.
-</p>
-""")
-        print("</div></div></div>")
-
-    def print_tutorial_list(self, jsonglob, prefix=None):
-        jsons = glob.glob(jsonglob)
-        ts = []
-        for pth in jsons:
-            dirname = os.path.dirname(pth)
-            metadata = yaml.safe_load(
-                open(os.path.join(dirname, 'metadata.yaml')))
-            build = json.load(open(os.path.join(dirname, 'build.json')))
-            if metadata.get('show_in_index', None) is False:
-                continue
-            ts.append(Tutorial(dirname, metadata))
-        if ts:
-            print(prefix)
-            print('<dl class="tutorials">')
-            for t in sorted(ts):
-                print('<dt><a href="//integrativemodeling.org/tutorials/%s/">'
-                      '%s</a></dt>' % (t.name, t.metadata['title']))
-                print('<dd>%s</dd>' % t.metadata.get('description', ''))
-            print("</dl>")
-
-    def print_header(self):
-        print('Content-type: text/html')
-        print('X-Robots-Tag: noindex, nofollow\n\n')
-
-        print("""
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
 <html>
 <head>
@@ -157,7 +91,143 @@ from source code</a> from the git <tt>develop</tt> branch.
     </ul>
   </div>
 </div>
-""" % {'stable': IMP_STABLE_RELEASE})
+
+""" % {'stable': IMP_STABLE_RELEASE}
+
+
+def _filter_repo_name(name):
+    # Special case the original imp_tutorial repository
+    if name == 'imp_tutorial':
+        return 'rnapolii_stalk'
+    if name.startswith('imp_'):
+        name = name[4:]
+    if name.endswith('_tutorial'):
+        name = name[:-9]
+    return name
+
+
+def _read_yaml(fname):
+    with open(fname, 'rb') as fh:
+        return yaml.load(fh.read(), Loader=_YAMLLoader)
+
+
+def _read_json(fname):
+    if orjson:
+        with open(fname, 'rb') as fh:
+            return orjson.loads(fh.read())
+    else:
+        with open(fname) as fh:
+            return json.load(fh)
+
+
+def _find_tutorials(depth, topdir=None):
+    """Yield each directory `depth` levels down that contains build.json"""
+    # Equivalent to glob.glob('*/' * depth + 'build.json') but with fewer
+    # system calls, as scandir gives us the file type with each entry
+    with os.scandir(topdir or '.') as it:
+        for entry in it:
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            path = os.path.join(topdir, entry.name) if topdir else entry.name
+            if depth > 1:
+                yield from _find_tutorials(depth - 1, path)
+            elif os.path.exists(os.path.join(path, 'build.json')):
+                yield path
+
+
+class Tutorial:
+    def __init__(self, name, metadata):
+        self.name, self.metadata = name, metadata
+        self._deps = frozenset(_filter_repo_name(x)
+                               for x in metadata.get('depends', []))
+
+
+def _toposort(ts):
+    """Yield the given tutorials in a sensible display order"""
+    # Simple ordering of tutorials:
+    # if one tutorial is explicitly listed as depending on another, it
+    # is ordered after the other; otherwise, tutorials with fewer dependencies
+    # are listed first (and ties are broken by name)
+    by_name = {t.name: t for t in ts}
+    ndeps = {}
+    dependents = collections.defaultdict(list)
+    for t in ts:
+        deps = [d for d in t._deps if d in by_name]
+        ndeps[t.name] = len(deps)
+        for d in deps:
+            dependents[d].append(t)
+
+    def sort_key(t):
+        return (len(t._deps), t.name)
+
+    ready = [sort_key(t) for t in ts if ndeps[t.name] == 0]
+    heapq.heapify(ready)
+    while ready:
+        _, name = heapq.heappop(ready)
+        yield by_name[name]
+        for t in dependents[name]:
+            ndeps[t.name] -= 1
+            if ndeps[t.name] == 0:
+                heapq.heappush(ready, sort_key(t))
+    # Don't drop any tutorials that are part of a dependency cycle
+    yield from sorted((t for t in ts if ndeps[t.name] > 0), key=sort_key)
+
+
+class Page:
+    def display(self):
+        # Build up the whole page and send it out with a single write. Write
+        # out whatever we have even if an error occurs, so that the headers
+        # precede any error message
+        buf = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(buf):
+                self.print_header()
+                self.show_tutorials()
+                self.print_footer()
+        finally:
+            sys.stdout.write(buf.getvalue())
+            sys.stdout.flush()
+
+    def show_tutorials(self):
+        print('<div style="padding-bottom: 1.7em"></div>')
+        print('<div class="header">')
+        print('<div class="headertitle">')
+        print('<div class="title">IMP Tutorial Index</div>')
+        print('</div></div>')
+        print('<div class="contents">')
+        print('<div class="textblock">')
+        self.print_tutorial_list(1, prefix='')
+        self.print_tutorial_list(2,
+                       prefix="""
+<h2>Tutorials for IMP nightly build</h2>
+<p>These tutorials demonstrate new features of IMP that are not in the
+most recent stable release. They will only work with a recent
+<a href="/download.html#develop">nightly build</a> of IMP, or IMP
+<a href="/nightly/doc/manual/installation.html#installation_source">compiled
+from source code</a> from the git <tt>develop</tt> branch.
+</p>
+""")
+        print("</div></div></div>")
+
+    def print_tutorial_list(self, depth, prefix=None):
+        ts = []
+        for dirname in _find_tutorials(depth):
+            metadata = _read_yaml(os.path.join(dirname, 'metadata.yaml'))
+            build = _read_json(os.path.join(dirname, 'build.json'))
+            if metadata.get('show_in_index', None) is False:
+                continue
+            ts.append(Tutorial(dirname, metadata))
+        if ts:
+            print(prefix)
+            print('<dl class="tutorials">')
+            for t in _toposort(ts):
+                print('<dt><a href="//integrativemodeling.org/tutorials/%s/">'
+                      '%s</a></dt>' % (t.name, t.metadata['title']))
+                print('<dd>%s</dd>' % t.metadata.get('description', ''))
+            print("</dl>")
+
+    def print_header(self):
+        sys.stdout.write(_HEADER_HTML)
 
     def print_footer(self):
         print("""
@@ -173,6 +243,7 @@ from source code</a> from the git <tt>develop</tt> branch.
 
 def email_error(email_to, email_from, exc_info):
     import smtplib
+    import traceback
     import email.utils
     from email.mime.text import MIMEText
     text = "".join(traceback.format_exception(*exc_info))
@@ -201,6 +272,7 @@ if __name__ == '__main__':
             raise
         else:
             email_error('ben@salilab.org', 'root@salilab.org', sys.exc_info())
+            import cgitb
             print(cgitb.reset())
             print("<p>Sorry, but an error was detected. We have been " \
                   "notified of the problem and will fix it shortly.</p>")